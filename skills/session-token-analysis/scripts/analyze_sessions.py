@@ -9,238 +9,2711 @@ No external dependencies — uses only Python standard library.
 """
 
 import argparse
+import bisect
+import bz2
+import cProfile
+import csv
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
+import lzma
+import math
+import mmap
 import os
+import random
+import re
+import signal
+import socketserver
+import sqlite3
+import struct
 import sys
-from datetime import datetime, timezone
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from urllib.parse import parse_qs, urlparse
 
+DEFAULT_CACHE_PATH = Path.home() / ".cache" / "session-token-analysis" / "parse-cache.sqlite3"
+DEFAULT_ROLLUP_PATH = Path.home() / ".cache" / "session-token-analysis" / "rollups.sqlite3"
 
-def find_session_files(num_sessions=5):
-    """Find the N most recent JSONL session files by modification time."""
-    claude_dir = Path.home() / ".claude" / "projects"
+# --rollup periods: (report heading, SQLite strftime label of each local-time bucket)
+ROLLUP_PERIODS = {
+    "hour": ("HOURLY", "%Y-%m-%d %H:00"),
+    "day": ("DAILY", "%Y-%m-%d"),
+    "week": ("WEEKLY", "%Y-W%W"),
+    "month": ("MONTHLY", "%Y-%m"),
+}
+
+# Rotated session logs are read through the matching stdlib decompressor
+COMPRESSED_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+# Binary per-session snapshots written by --archive
+SNAPSHOT_SUFFIX = ".ccsnap"
+
+# File names discovery treats as sessions
+SESSION_SUFFIXES = (".jsonl", ".jsonl.gz", ".jsonl.bz2", ".jsonl.xz", SNAPSHOT_SUFFIX)
+
+# Sub-agent transcripts live in <session-id>/subagents/ beside their session;
+# they are folded into that session rather than discovered on their own
+SUBAGENTS_DIR = "subagents"
+
+# Message role codes SessionAccumulator folds messages by
+ROLE_OTHER, ROLE_USER, ROLE_TOOL_RESULT, ROLE_ASSISTANT = range(4)
+
+# Context size the recommendations tell users to /compact before
+COMPACT_THRESHOLD = 80_000
+
+# Lines at least this long go through the selective decoder in decode_entry()
+SELECTIVE_DECODE_MIN_BYTES = 16 * 1024
+
+# Top-level entry fields parse_entry() reads; everything else is never decoded.
+# The selective decoder stops once the required ones are read; the sidechain
+# links are written before them, so they never cost a walk over toolUseResult.
+ENTRY_FIELDS = frozenset(("message", "timestamp", "isSidechain", "uuid", "parentUuid", "agentId"))
+ENTRY_REQUIRED_FIELDS = frozenset(("message", "timestamp"))
+
+# Rough characters-per-token ratio used to turn tool result sizes into tokens
+CHARS_PER_TOKEN = 4
+
+# Prompt cache lifetime; an idle gap longer than this before a rebuild blames expiry
+CACHE_TTL_SECONDS = 5 * 60
+
+# A mid-session turn that writes at least this many tokens, and at least half
+# of its context, to the cache is counted as a cache rebuild
+CACHE_REBUILD_MIN_TOKENS = 5_000
+
+# Idle-gap histogram buckets: (upper bound in seconds, label)
+IDLE_GAP_BINS = (
+    (60, "<1m"), (CACHE_TTL_SECONDS, "1-5m"), (15 * 60, "5-15m"),
+    (60 * 60, "15-60m"), (4 * 60 * 60, "1-4h"), (math.inf, ">4h"),
+)
+
+
+def iter_session_entries(root, project=None, since=None, until=None, with_stat=False, where=None):
+    """Yield (mtime, path) for every session file under root that passes the filters.
+
+    Session files are .jsonl logs, their .gz/.bz2/.xz rotations and
+    --archive snapshots (SESSION_SUFFIXES). Sub-agent transcripts under a
+    `subagents` directory are skipped; they belong to their parent session.
+
+    Built on os.scandir so each file is stat'ed at most once through its
+    DirEntry. Project directories (the first level under root) whose name
+    doesn't contain `project` are pruned before anything inside them is
+    listed or stat'ed, as are those failing the project terms of a
+    SessionFilter `where`. `since`/`until` are epoch seconds bounds on
+    mtime. With with_stat, yields (mtime, path, stat_result) instead.
+    """
+    stack = []
+    root_matches = where is None or where.match_project(Path(root).name)
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if (project is None or project in entry.name) and (where is None or where.match_project(entry.name)):
+                        stack.append(entry.path)
+                elif project is None and root_matches and entry.name.endswith(SESSION_SUFFIXES) and entry.is_file():
+                    stack.append(entry)
+    except OSError:
+        return
+
+    while stack:
+        item = stack.pop()
+        if isinstance(item, os.DirEntry):
+            entries = (item,)
+        else:
+            try:
+                with os.scandir(item) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+        for entry in entries:
+            if entry.name.endswith(SESSION_SUFFIXES):
+                if not entry.is_file():
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                mtime = st.st_mtime
+                if since is not None and mtime < since:
+                    continue
+                if until is not None and mtime >= until:
+                    continue
+                yield (mtime, Path(entry.path), st) if with_stat else (mtime, Path(entry.path))
+            elif entry.is_dir(follow_symlinks=False) and entry.name != SUBAGENTS_DIR:
+                stack.append(entry.path)
+
+
+def iter_oldest_first(entries):
+    """Yield the paths of iter_session_entries() results oldest first.
+
+    Entries are grouped by directory and each directory holds only
+    (mtime, file name) pairs, sorted in place; heapq.merge then streams the
+    directories together lazily. That is about 180 bytes per file, against
+    over 400 for a sorted list of (mtime, Path) pairs, and no Path is
+    kept before its file is next in line.
+    """
+    by_dir = {}
+    for mtime, path in entries:
+        by_dir.setdefault(str(path.parent), []).append((mtime, path.name))
+
+    def directory(parent, files):
+        files.sort()
+        for mtime, name in files:
+            yield mtime, parent, name
+
+    merged = heapq.merge(*(directory(parent, files) for parent, files in by_dir.items()))
+    by_dir = None
+    for _, parent, name in merged:
+        yield Path(parent) / name
+
+
+def projects_dir(root=None):
+    """Return the session root (default ~/.claude/projects), exiting if it doesn't exist."""
+    claude_dir = Path(root) if root is not None else Path.home() / ".claude" / "projects"
     if not claude_dir.exists():
         print(f"Error: {claude_dir} does not exist.", file=sys.stderr)
         sys.exit(1)
+    return claude_dir
+
+
+def session_id(path):
+    """Session id of a session file: its name without .jsonl[.gz|.bz2|.xz] or the snapshot suffix."""
+    return Path(path).name.split(".", 1)[0]
+
+
+def subagent_files(path):
+    """Sub-agent transcripts of a session: <session-id>/subagents/*.jsonl[.gz|.bz2|.xz] beside it."""
+    directory = Path(path).parent / session_id(path) / SUBAGENTS_DIR
+    try:
+        with os.scandir(directory) as it:
+            return sorted(Path(e.path) for e in it if e.name.endswith(SESSION_SUFFIXES[:-1]) and e.is_file())
+    except OSError:
+        return []
+
+
+def session_signature(path, st):
+    """(size, mtime_ns) of a session together with its sub-agent transcripts, for change detection.
+
+    A running sub-agent only appends to its own file, so the parent's stat
+    alone would miss it until the Task result lands.
+    """
+    size, mtime_ns = st.st_size, st.st_mtime_ns
+    for sub_path in subagent_files(path):
+        try:
+            sub = sub_path.stat()
+        except OSError:
+            continue
+        size += sub.st_size
+        mtime_ns = max(mtime_ns, sub.st_mtime_ns)
+    return size, mtime_ns
 
-    jsonl_files = []
-    for root, _dirs, files in os.walk(claude_dir):
-        for f in files:
-            if f.endswith(".jsonl"):
-                full_path = Path(root) / f
-                mtime = full_path.stat().st_mtime
-                jsonl_files.append((mtime, full_path))
 
-    jsonl_files.sort(key=lambda x: x[0], reverse=True)
+def open_session_file(path):
+    """Open a session log for binary reading, decompressing by suffix; None for plain files."""
+    opener = COMPRESSED_OPENERS.get(Path(path).suffix)
+    return opener(path, "rb") if opener else None
+
+
+def find_session_files(num_sessions=5, project=None, since=None, until=None, root=None, where=None):
+    """Find the N most recent session files by modification time.
+
+    Uses a bounded heap, so only num_sessions candidates are held at once.
+    Pass num_sessions=None to return every matching file, newest first.
+    `root` defaults to ~/.claude/projects; `where` prunes project directories.
+    """
+    claude_dir = projects_dir(root)
+    entries = iter_session_entries(claude_dir, project, since, until, where=where)
+    if num_sessions is None:
+        jsonl_files = sorted(entries, key=lambda x: x[0], reverse=True)
+    else:
+        jsonl_files = heapq.nlargest(num_sessions, entries, key=lambda x: x[0])
 
     if not jsonl_files:
         print("Error: No .jsonl session files found.", file=sys.stderr)
         sys.exit(1)
 
-    return [path for _, path in jsonl_files[:num_sessions]]
+    return [path for _, path in jsonl_files]
 
 
-def parse_session(file_path):
-    """Parse a single JSONL session file and extract metrics."""
-    messages = []
-    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
-        for line_num, line in enumerate(f, 1):
-            line = line.strip()
+def parse_date_arg(value, end_of_day=False):
+    """argparse type for --since/--until: ISO date or datetime to epoch seconds (local time if naive).
+
+    With end_of_day, a bare date means the end of that day, so --until is inclusive.
+    """
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date: {value!r} (expected YYYY-MM-DD or ISO datetime)")
+    if end_of_day and len(value) == 10:
+        dt += timedelta(days=1)
+    return dt.timestamp()
+
+
+# --where fields compared on the computed metrics: name -> value getter
+WHERE_METRIC_FIELDS = {
+    "turns": lambda m: m["assistant_messages"],
+    "cost": lambda m: m["cost_total"],
+    "peak": lambda m: m["peak_effective"],
+    "effective": lambda m: m["effective_input"],
+    "output": lambda m: m["total_output"],
+    "cache": lambda m: m["cache_hit_rate"],
+    "growth": lambda m: m["context_growth"],
+    "tools": lambda m: m["total_tool_uses"],
+    "compactions": lambda m: len(m["compaction_events"]),
+    "rebuilds": lambda m: m["cache_rebuild_count"],
+    "duration": lambda m: m["duration"].total_seconds() / 60 if m["duration"] is not None else 0.0,
+}
+
+# --where text fields: name -> metrics key; `~` is a (case-sensitive) substring match
+WHERE_TEXT_FIELDS = {"project": "project_dir", "model": "model", "command": "command"}
+
+WHERE_COMPARISONS = {
+    "=": lambda a, b: a == b, "!=": lambda a, b: a != b,
+    ">": lambda a, b: a > b, ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b, "<=": lambda a, b: a <= b,
+}
+
+_where_term = re.compile(r"([a-z_]+)\s*(!~|!=|>=|<=|=|~|>|<)\s*(.*)", re.IGNORECASE)
+
+
+def _where_number(field, text):
+    """Parse a --where metric value: K/M suffixes, a leading $, a trailing %, m/h for duration."""
+    text = text.strip().lstrip("$").rstrip("%")
+    if field == "duration":
+        scale = {"h": 60, "m": 1}.get(text[-1:].lower(), None)
+    else:
+        scale = {"K": 1_000, "M": 1_000_000}.get(text[-1:].upper(), None)
+    return float(text[:-1] if scale else text) * (scale or 1)
+
+
+class SessionFilter:
+    """A parsed --where expression: `field op value` terms joined by `and`.
+
+    Each term is applied as early as it can be. Project terms prune project
+    directories during discovery and since/until bound file mtimes there,
+    so files that can't match are never opened. Positive model and command
+    terms must appear in the raw bytes of a plain .jsonl file before any of
+    it is decoded, and a model term is checked again as soon as the first
+    assistant turn names the model. The rest are checked on the metrics.
+    """
+
+    def __init__(self, terms, text=""):
+        self.terms = terms  # (field, op, value) with numbers and dates already parsed
+        self.text = text
+        self.since = max((v for f, _, v in terms if f == "since"), default=None)
+        self.until = min((v for f, _, v in terms if f == "until"), default=None)
+        self.has_model_terms = any(f == "model" for f, _, _ in terms)
+        # Values that appear verbatim in the JSON log (no escaping needed)
+        self.needles = [
+            v.encode() for f, op, v in terms
+            if f in ("model", "command") and op in ("=", "~") and v.isascii() and v.isprintable()
+            and '"' not in v and "\\" not in v
+        ]
+
+    def bounds(self, since=None, until=None):
+        """Combine --since/--until with the expression's own since/until terms."""
+        if self.since is not None:
+            since = self.since if since is None else max(since, self.since)
+        if self.until is not None:
+            until = self.until if until is None else min(until, self.until)
+        return since, until
+
+    @staticmethod
+    def _match_text(field, op, value, text):
+        if field == "command":
+            text, value = text.lstrip("/"), value.lstrip("/")
+        if op == "~":
+            return value in text
+        if op == "!~":
+            return value not in text
+        return (text == value) == (op == "=")
+
+    def match_project(self, name):
+        return all(self._match_text(f, op, v, name) for f, op, v in self.terms if f == "project")
+
+    def match_model(self, model):
+        return all(self._match_text(f, op, v, model) for f, op, v in self.terms if f == "model")
+
+    def may_match_file(self, path):
+        """False only when a plain .jsonl file lacks a value a model/command term needs."""
+        if not self.needles or not str(path).endswith(".jsonl"):
+            return True
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return True
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return all(mm.find(needle) != -1 for needle in self.needles)
+        except (OSError, ValueError):
+            return True
+
+    def matches(self, metrics):
+        """Check every text and metric term against a session's metrics."""
+        for field, op, value in self.terms:
+            if field in WHERE_TEXT_FIELDS:
+                if not self._match_text(field, op, value, metrics[WHERE_TEXT_FIELDS[field]] or ""):
+                    return False
+            elif field in WHERE_METRIC_FIELDS:
+                if not WHERE_COMPARISONS[op](WHERE_METRIC_FIELDS[field](metrics), value):
+                    return False
+        return True
+
+
+def parse_where(value):
+    """argparse type for --where: parse e.g. 'model~opus and turns>60 and since=2026-09-01'."""
+    terms = []
+    for text in re.split(r"\s+and\s+", value.strip(), flags=re.IGNORECASE):
+        match = _where_term.fullmatch(text.strip())
+        if not match:
+            raise argparse.ArgumentTypeError(f"invalid --where term: {text!r} (expected FIELD OP VALUE)")
+        field, op, raw = match.group(1).lower(), match.group(2), match.group(3).strip().strip("'\"")
+        if field in WHERE_TEXT_FIELDS:
+            if op not in ("=", "!=", "~", "!~"):
+                raise argparse.ArgumentTypeError(f"{field} supports =, !=, ~ and !~, not {op!r}")
+            terms.append((field, op, raw))
+        elif field in ("since", "until"):
+            if op != "=":
+                raise argparse.ArgumentTypeError(f"{field} only supports = (e.g. {field}=2026-09-01)")
+            terms.append((field, op, parse_date_arg(raw, end_of_day=field == "until")))
+        elif field in WHERE_METRIC_FIELDS:
+            if op not in WHERE_COMPARISONS:
+                raise argparse.ArgumentTypeError(f"{field} supports =, !=, <, <=, > and >=, not {op!r}")
+            try:
+                terms.append((field, op, _where_number(field, raw)))
+            except ValueError:
+                raise argparse.ArgumentTypeError(f"invalid number for {field}: {raw!r}")
+        else:
+            fields = ", ".join([*WHERE_TEXT_FIELDS, "since", "until", *WHERE_METRIC_FIELDS])
+            raise argparse.ArgumentTypeError(f"unknown --where field {field!r} (one of: {fields})")
+    return SessionFilter(terms, value.strip())
+
+
+_command_name = re.compile(r"<command-name>\s*(.*?)\s*</command-name>")
+
+_json_decoder = json.JSONDecoder()
+_json_ws = re.compile(r"[ \t\n\r]*")
+
+
+def _skip_value(line, idx):
+    """Return the end index of the JSON value at line[idx], discarding the value.
+
+    The C scanner is used even for strings: it finds the closing quote faster
+    than a regex or a find() loop over escapes, and the copy is dropped at once.
+    """
+    if line[idx] == '"':
+        return json.decoder.scanstring(line, idx + 1)[1]
+    return _json_decoder.raw_decode(line, idx)[1]
+
+
+def _decode_object(line, idx, decode_member):
+    """Decode the JSON object at line[idx]; decode_member(key, line, idx) returns (key, value, end)."""
+    ws = _json_ws.match
+    if line[idx] != "{":
+        raise ValueError("not a JSON object")
+    out = {}
+    idx = ws(line, idx + 1).end()
+    if line[idx] == "}":
+        return out, idx + 1
+    while True:
+        if line[idx] != '"':
+            raise ValueError("expected key")
+        key, idx = json.decoder.scanstring(line, idx + 1)
+        idx = ws(line, idx).end()
+        if line[idx] != ":":
+            raise ValueError("expected ':'")
+        key, value, idx = decode_member(key, line, ws(line, idx + 1).end())
+        out[key] = value
+        idx = ws(line, idx).end()
+        if line[idx] == "}":
+            return out, idx + 1
+        if line[idx] != ",":
+            raise ValueError("expected ',' or '}'")
+        idx = ws(line, idx + 1).end()
+
+
+def _decode_member(key, line, idx):
+    value, end = _json_decoder.raw_decode(line, idx)
+    return key, value, end
+
+
+def _block_member(key, line, idx):
+    # A content block's own `content` is a tool_result payload: keep only its size
+    if key == "content":
+        end = _skip_value(line, idx)
+        return "content_chars", end - idx, end
+    return _decode_member(key, line, idx)
+
+
+def _message_member(key, line, idx):
+    if key != "content" or line[idx] != "[":
+        return _decode_member(key, line, idx)
+    ws = _json_ws.match
+    blocks = []
+    idx = ws(line, idx + 1).end()
+    if line[idx] == "]":
+        return key, blocks, idx + 1
+    while True:
+        if line[idx] == "{":
+            block, idx = _decode_object(line, idx, _block_member)
+        else:
+            block, idx = _json_decoder.raw_decode(line, idx)
+        blocks.append(block)
+        idx = ws(line, idx).end()
+        if line[idx] == "]":
+            return key, blocks, idx + 1
+        if line[idx] != ",":
+            raise ValueError("expected ',' or ']'")
+        idx = ws(line, idx + 1).end()
+
+
+def decode_entry_fields(line, fields=ENTRY_FIELDS, required=ENTRY_REQUIRED_FIELDS):
+    """Decode only the wanted top-level fields of a JSON object line.
+
+    Walks the top-level object key by key and stops as soon as every
+    `required` field has been read (optional `fields` only if they came
+    first). Claude Code writes `message` and `timestamp` before
+    the `toolUseResult` copy of a tool's output, so on tool-heavy lines the
+    largest payload is never decoded. Inside `message`, each tool_result
+    block's payload is only measured: its `content` is replaced by
+    `content_chars`, the length of its raw JSON span. Raises ValueError (or
+    IndexError) on anything it cannot walk; callers fall back to json.loads.
+
+    Expects a stripped line. Because it stops early it is more lenient than
+    json.loads: a line that is cut off (no closing `}`) is rejected, but
+    malformed JSON after the last field it needs, such as trailing garbage
+    past the closing brace, is not noticed and the line is still accepted.
+    benchmark_sessions.py --verify checks it against json.loads.
+    """
+    if not line.endswith("}"):
+        raise ValueError("truncated JSON object")
+    ws = _json_ws.match
+    idx = ws(line, 0).end()
+    if line[idx] != "{":
+        raise ValueError("not a JSON object")
+    out = {}
+    remaining = len(required)
+    idx = ws(line, idx + 1).end()
+    if line[idx] == "}":
+        return out
+    while True:
+        if line[idx] != '"':
+            raise ValueError("expected key")
+        key, idx = json.decoder.scanstring(line, idx + 1)
+        idx = ws(line, idx).end()
+        if line[idx] != ":":
+            raise ValueError("expected ':'")
+        idx = ws(line, idx + 1).end()
+        if key == "message" and line[idx] == "{":
+            value, idx = _decode_object(line, idx, _message_member)
+        else:
+            value, idx = _json_decoder.raw_decode(line, idx)
+        if key in fields:
+            out[key] = value
+            if key in required:
+                remaining -= 1
+                if not remaining:
+                    return out
+        idx = ws(line, idx).end()
+        if line[idx] == "}":
+            return out
+        if line[idx] != ",":
+            raise ValueError("expected ',' or '}'")
+        idx = ws(line, idx + 1).end()
+
+
+def decode_entry(line, complete=True):
+    """Decode a session line, using the selective decoder for large complete lines."""
+    if complete and len(line) >= SELECTIVE_DECODE_MIN_BYTES:
+        try:
+            return decode_entry_fields(line)
+        except (ValueError, IndexError):
+            pass
+    return json.loads(line)
+
+
+def _content_chars(block):
+    """Size of a tool_result payload as serialised JSON, in characters."""
+    size = block.get("content_chars")  # measured by decode_entry_fields
+    if size is not None:
+        return size
+    payload = block.get("content")
+    if not payload:
+        return 0
+    if isinstance(payload, str):
+        return len(json.encoder.encode_basestring(payload))
+    return len(json.dumps(payload, ensure_ascii=False, separators=(",", ":")))
+
+
+def parse_entry(entry):
+    """Extract the analysed fields from one decoded JSONL entry, or None to skip it."""
+    msg = entry.get("message")
+    if not msg:
+        return None
+
+    role = msg.get("role", "")
+    usage = msg.get("usage", {})
+    content = msg.get("content", [])
+    timestamp = entry.get("timestamp")
+
+    # Parse timestamp (kept as epoch seconds; naive timestamps are taken as UTC)
+    ts = None
+    if timestamp:
+        try:
+            dt = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            ts = dt.timestamp()
+        except (ValueError, AttributeError):
+            pass
+
+    # Count tool uses and tool results in content blocks; keep tool_use ids and
+    # names, and tool_result ids with the size of their payload in characters
+    tool_use_count = 0
+    tool_calls = []
+    tool_results = []
+    has_tool_result = False
+    has_user_text = False
+    text = None
+    if isinstance(content, list):
+        for block in content:
+            if isinstance(block, dict):
+                if block.get("type") == "tool_use":
+                    tool_use_count += 1
+                    tool_calls.append([block.get("id"), block.get("name") or "unknown"])
+                elif block.get("type") == "tool_result":
+                    has_tool_result = True
+                    tool_results.append([block.get("tool_use_id"), _content_chars(block)])
+                elif block.get("type") == "text" and block.get("text", "").strip():
+                    has_user_text = True
+                    text = text or block["text"]
+    elif isinstance(content, str) and content.strip():
+        has_user_text = True
+        text = content
+
+    # Classify user messages: tool_result-only vs real user input
+    is_tool_result_only = (role == "user" and has_tool_result and not has_user_text)
+
+    # Sub-agent (sidechain) messages keep their links for grouping into branches
+    is_sidechain = bool(entry.get("isSidechain"))
+
+    # Slash command the user invoked (e.g. /brainstorm), used to label workflow phases
+    command = None
+    if role == "user" and text and "<command-name>" in text:
+        match = _command_name.search(text)
+        if match:
+            command = match.group(1)
+
+    return {
+        "role": role,
+        "is_tool_result_only": is_tool_result_only,
+        "model": msg.get("model", ""),
+        "input_tokens": usage.get("input_tokens", 0),
+        "output_tokens": usage.get("output_tokens", 0),
+        "cache_creation_input_tokens": usage.get("cache_creation_input_tokens", 0),
+        "cache_read_input_tokens": usage.get("cache_read_input_tokens", 0),
+        "timestamp": ts,
+        "tool_use_count": tool_use_count,
+        "command": command,
+        "tool_calls": tool_calls or None,
+        "tool_results": tool_results or None,
+        "message_id": msg.get("id"),
+        "is_sidechain": is_sidechain,
+        "uuid": entry.get("uuid"),
+        "parent_uuid": entry.get("parentUuid") if is_sidechain else None,
+        "agent_id": entry.get("agentId") if is_sidechain else None,
+    }
+
+
+class ReadStats:
+    """Counters for what a SessionReader (and the parse cache) did with a file."""
+
+    __slots__ = ("bytes_read", "lines_decoded", "lines_skipped", "lines_prefiltered",
+                 "messages", "messages_cached")
+
+    def __init__(self):
+        self.bytes_read = 0
+        self.lines_decoded = 0
+        self.lines_skipped = 0  # JSONDecodeError
+        self.lines_prefiltered = 0  # no "message" key, never decoded
+        self.messages = 0
+        self.messages_cached = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class SessionReader:
+    """Stream parsed messages from a session file, starting at a byte offset.
+
+    Iterating yields one message dict per usable line; `offset` tracks the end
+    of the last consumed line. A trailing line without a newline is only
+    consumed if it already decodes, so a line still being written is picked up
+    on the next read instead of being lost. Work done is tallied in `stats`.
+    """
+
+    def __init__(self, file_path, offset=0, stats=None):
+        self.file_path = file_path
+        self.offset = offset
+        self.stats = stats if stats is not None else ReadStats()
+
+    def __iter__(self):
+        stream = open_session_file(self.file_path)
+        if stream is not None:
+            with stream:
+                yield from self._iter_stream(stream)
+            return
+        with open(self.file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= self.offset:
+                return
+            stats = self.stats
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = self.offset
+                while pos < size:
+                    nl = mm.find(b"\n", pos, size)
+                    complete = nl != -1
+                    end = nl + 1 if complete else size
+                    stats.bytes_read += end - pos
+
+                    # Byte-level pre-check: a line without a "message" key can't
+                    # produce a message, so skip it without copying or decoding
+                    if complete and mm.find(b'"message"', pos, end) == -1:
+                        stats.lines_prefiltered += 1
+                        self.offset = pos = end
+                        continue
+
+                    line = mm[pos:end].decode("utf-8", errors="replace").strip()
+                    if not line:
+                        self.offset = pos = end
+                        continue
+                    try:
+                        entry = decode_entry(line, complete)
+                    except json.JSONDecodeError:
+                        stats.lines_skipped += 1
+                        if not complete:
+                            break
+                        self.offset = pos = end
+                        continue
+                    stats.lines_decoded += 1
+                    self.offset = pos = end
+
+                    msg = parse_entry(entry) if isinstance(entry, dict) else None
+                    if msg is not None:
+                        stats.messages += 1
+                        yield msg
+
+    def _iter_stream(self, stream):
+        """Same as the mmap path, over a decompressing stream; offsets count decompressed bytes."""
+        stats = self.stats
+        if self.offset:
+            stream.seek(self.offset)
+        for raw in stream:
+            end = self.offset + len(raw)
+            complete = raw.endswith(b"\n")
+            stats.bytes_read += len(raw)
+            if complete and b'"message"' not in raw:
+                stats.lines_prefiltered += 1
+                self.offset = end
+                continue
+            line = raw.decode("utf-8", errors="replace").strip()
             if not line:
+                self.offset = end
                 continue
             try:
-                entry = json.loads(line)
+                entry = decode_entry(line, complete)
             except json.JSONDecodeError:
+                stats.lines_skipped += 1
+                if not complete:
+                    break
+                self.offset = end
+                continue
+            stats.lines_decoded += 1
+            self.offset = end
+            msg = parse_entry(entry) if isinstance(entry, dict) else None
+            if msg is not None:
+                stats.messages += 1
+                yield msg
+
+
+def role_code(msg):
+    """Map a parsed message to its ROLE_* code."""
+    role = msg["role"]
+    if role == "assistant":
+        return ROLE_ASSISTANT
+    if role == "user":
+        return ROLE_TOOL_RESULT if msg["is_tool_result_only"] else ROLE_USER
+    return ROLE_OTHER
+
+
+def parse_session(file_path):
+    """Parse a single JSONL session file into a list of message dicts (see parse_entry)."""
+    return list(SessionReader(file_path))
+
+
+class ParseCache:
+    """On-disk SQLite cache of parsed session messages.
+
+    Session JSONL files are append-only, so each file is stored with its size,
+    mtime and the byte offset parsing stopped at. Unchanged files are served
+    from the cache without being opened; grown files only have the appended
+    bytes parsed. Anything else (truncated or rewritten) is parsed from scratch.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            message_count INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            file_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            is_tool_result_only INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            input_tokens INTEGER NOT NULL,
+            output_tokens INTEGER NOT NULL,
+            cache_creation_input_tokens INTEGER NOT NULL,
+            cache_read_input_tokens INTEGER NOT NULL,
+            timestamp REAL,
+            tool_use_count INTEGER NOT NULL,
+            command TEXT,
+            tool_calls TEXT,
+            tool_results TEXT,
+            message_id TEXT,
+            is_sidechain INTEGER NOT NULL,
+            uuid TEXT,
+            parent_uuid TEXT,
+            agent_id TEXT,
+            PRIMARY KEY (file_id, seq)
+        ) WITHOUT ROWID;
+    """
+
+    MESSAGE_COLUMNS = (
+        "role", "is_tool_result_only", "model", "input_tokens", "output_tokens",
+        "cache_creation_input_tokens", "cache_read_input_tokens", "timestamp",
+        "tool_use_count", "command", "tool_calls", "tool_results", "message_id",
+        "is_sidechain", "uuid", "parent_uuid", "agent_id",
+    )
+
+    INSERT_BATCH = 1000
+
+    # Bump when the schema or stored field meaning changes; old caches are rebuilt
+    SCHEMA_VERSION = 6
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.db_path), timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            self.conn.executescript("DROP TABLE IF EXISTS messages; DROP TABLE IF EXISTS files;")
+            self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def iter_messages(self, file_path, stats=None):
+        """Stream the messages for file_path: cached rows first, then any newly parsed lines.
+
+        New messages are written back as they stream past. The update is one
+        transaction, so a consumer that stops early leaves the cache untouched.
+        """
+        stats = stats if stats is not None else ReadStats()
+        path = str(file_path)
+        st = os.stat(path)
+        row = self.conn.execute(
+            "SELECT id, size, mtime_ns, offset, message_count FROM files WHERE path = ?",
+            (path,),
+        ).fetchone()
+
+        with self.conn:
+            if row is not None:
+                file_id, size, mtime_ns, offset, message_count = row
+                if st.st_size == size and st.st_mtime_ns == mtime_ns:
+                    yield from self._iter_rows(file_id, stats)
+                    return
+                if st.st_size >= offset and self._ends_line(path, offset):
+                    yield from self._iter_rows(file_id, stats)
+                    seq = message_count
+                else:
+                    self.conn.execute("DELETE FROM messages WHERE file_id = ?", (file_id,))
+                    offset = seq = 0
+            else:
+                file_id = self.conn.execute(
+                    "INSERT INTO files (path, size, mtime_ns, offset, message_count) "
+                    "VALUES (?, 0, 0, 0, 0)",
+                    (path,),
+                ).lastrowid
+                offset = seq = 0
+
+            reader = SessionReader(path, offset, stats)
+            batch = []
+            for msg in reader:
+                batch.append(msg)
+                yield msg
+                if len(batch) >= self.INSERT_BATCH:
+                    self._insert(file_id, seq, batch)
+                    seq += len(batch)
+                    batch = []
+            self._insert(file_id, seq, batch)
+            self.conn.execute(
+                "UPDATE files SET size = ?, mtime_ns = ?, offset = ?, message_count = ? "
+                "WHERE id = ?",
+                (st.st_size, st.st_mtime_ns, reader.offset, seq + len(batch), file_id),
+            )
+
+    @staticmethod
+    def _ends_line(path, offset):
+        """Check the cached offset still sits on a line boundary (file was appended to, not rewritten)."""
+        if offset == 0:
+            return True
+        if Path(path).suffix in COMPRESSED_OPENERS:
+            # A changed compressed file is a new rotation: parse it from scratch
+            return False
+        with open(path, "rb") as f:
+            f.seek(offset - 1)
+            return f.read(1) == b"\n"
+
+    def _iter_rows(self, file_id, stats):
+        rows = self.conn.execute(
+            f"SELECT {', '.join(self.MESSAGE_COLUMNS)} FROM messages "
+            "WHERE file_id = ? ORDER BY seq",
+            (file_id,),
+        )
+        for row in rows:
+            msg = dict(zip(self.MESSAGE_COLUMNS, row))
+            msg["is_tool_result_only"] = bool(msg["is_tool_result_only"])
+            msg["is_sidechain"] = bool(msg["is_sidechain"])
+            for key in ("tool_calls", "tool_results"):
+                if msg[key] is not None:
+                    msg[key] = json.loads(msg[key])
+            stats.messages_cached += 1
+            yield msg
+
+    def _insert(self, file_id, start_seq, messages):
+        self.conn.executemany(
+            f"INSERT INTO messages (file_id, seq, {', '.join(self.MESSAGE_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * (len(self.MESSAGE_COLUMNS) + 2))})",
+            (
+                (
+                    file_id, start_seq + i, m["role"], int(m["is_tool_result_only"]),
+                    m["model"] or "", m["input_tokens"] or 0, m["output_tokens"] or 0,
+                    m["cache_creation_input_tokens"] or 0, m["cache_read_input_tokens"] or 0,
+                    m["timestamp"],
+                    m["tool_use_count"], m.get("command"),
+                    json.dumps(m["tool_calls"]) if m.get("tool_calls") else None,
+                    json.dumps(m["tool_results"]) if m.get("tool_results") else None,
+                    m.get("message_id"), int(m.get("is_sidechain", False)),
+                    m.get("uuid"), m.get("parent_uuid"), m.get("agent_id"),
+                )
+                for i, m in enumerate(messages)
+            ),
+        )
+
+
+def model_pricing(model):
+    """Return (input, output, cache_create, cache_read) prices per million tokens for a model."""
+    if "opus" in model:
+        return 15.0, 75.0, 18.75, 1.875
+    elif "haiku" in model:
+        return 0.80, 4.0, 1.0, 0.08
+    else:  # sonnet or unknown — use sonnet pricing
+        return 3.0, 15.0, 3.75, 0.30
+
+
+def to_datetime(ts):
+    """Convert epoch seconds to an aware UTC datetime (None passes through)."""
+    return datetime.fromtimestamp(ts, timezone.utc) if ts is not None else None
+
+
+class SessionAccumulator:
+    """Single-pass metrics accumulator for one session.
+
+    Consumes parsed messages one at a time via add() and keeps every metric
+    current as a running scalar. The only state that grows with the session
+    is the per-turn series (effective context, output tokens, timestamp and
+    cumulative cost, one typed array slot each per turn), one small tuple
+    per tool result for tool_attribution(), one dict per cache rebuild and
+    one small list per clock hour and model the session's turns fall in.
+
+    Sidechain (sub-agent) messages go to a child accumulator per branch
+    instead, so the per-turn series, peak and compactions describe the main
+    thread alone; metrics() adds the branches back into the token and cost
+    totals. A sidechain message joins the branch of its agentId, else of
+    its parentUuid, else starts a new one: one dict lookup per message.
+    """
+
+    def __init__(self):
+        self.total_messages = 0
+        self.user_messages = 0
+        self.tool_result_messages = 0
+        self.start_time = None
+        self.end_time = None
+        self.total_input = 0
+        self.total_output = 0
+        self.total_cache_creation = 0
+        self.total_cache_read = 0
+        self.assistant_output = 0
+        self.total_tool_uses = 0
+        self.model = "unknown"
+        self.command = None
+        self.per_turn_effective = array("q")
+        self.per_turn_output = array("q")
+        self.per_turn_time = array("d")
+        self.per_turn_cost = array("d")
+        self.peak_effective = 0
+        self.peak_turn = 0
+        self.compaction_events = []
+        self.duplicate_messages = 0  # skipped as already counted in an earlier file
+        self.cache_rebuilds = []
+        self.idle_gap_counts = [0] * len(IDLE_GAP_BINS)
+        self.idle_gap_rebuild_cost = [0.0] * len(IDLE_GAP_BINS)
+        self._tool_names = {}  # tool_use id -> name, until its result arrives
+        self._tool_results = []  # (name, tool_use_id, estimated tokens, turns before it arrived)
+        self._uncached_results = 0  # index of the first result no turn has cached yet
+        self.unmatched_tool_results = 0  # results whose tool_use isn't in this session, left unpriced
+        self.hourly = {}  # (hour start in epoch seconds, model) -> [turns, effective, cache read, output, cost]
+        self._last_hour = None
+        self.subagents = {}  # branch key (agent id or sidechain-N) -> SessionAccumulator
+        self.spawned_at_turn = 0  # for a branch: main-thread turns before its first message
+        self._branch_of = {}  # sidechain message uuid -> branch key
+
+    def add(self, m):
+        """Fold one parsed message dict into the running metrics."""
+        self._add(
+            role_code(m), m["input_tokens"] or 0, m["output_tokens"] or 0,
+            m["cache_creation_input_tokens"] or 0, m["cache_read_input_tokens"] or 0,
+            m["timestamp"], m["tool_use_count"], m["model"], m.get("command"),
+            m.get("tool_calls"), m.get("tool_results"),
+            (m.get("uuid"), m.get("parent_uuid"), m.get("agent_id")) if m.get("is_sidechain") else None,
+        )
+
+    @property
+    def message_count(self):
+        """Messages consumed, main thread and sub-agents together."""
+        return self.total_messages + sum(b.total_messages for b in self.subagents.values())
+
+    def _branch(self, uuid, parent_uuid, agent_id):
+        key = agent_id or self._branch_of.get(parent_uuid)
+        if key is None:
+            key = f"sidechain-{len(self.subagents) + 1}"
+        if uuid:
+            self._branch_of[uuid] = key
+        branch = self.subagents.get(key)
+        if branch is None:
+            branch = self.subagents[key] = SessionAccumulator()
+            branch.spawned_at_turn = len(self.per_turn_effective)
+        return branch
+
+    def _add(self, role, inp, out, cache_create, cache_read, ts, tool_uses, model, command=None,
+             tool_calls=None, tool_results=None, sidechain=None):
+        if sidechain is not None:
+            self._branch(*sidechain)._add(role, inp, out, cache_create, cache_read, ts, tool_uses, model,
+                                          command, tool_calls, tool_results)
+            return
+        self.total_messages += 1
+        if command and self.command is None:
+            self.command = command
+        if tool_calls:
+            for tool_id, name in tool_calls:
+                self._tool_names[tool_id] = name
+        if tool_results:
+            turn = len(self.per_turn_effective)
+            for tool_id, chars in tool_results:
+                name = self._tool_names.pop(tool_id, None)
+                if name is None:
+                    # Its tool_use was made in another session (e.g. a copy a resume carried over)
+                    self.unmatched_tool_results += 1
+                else:
+                    self._tool_results.append((name, tool_id, round(chars / CHARS_PER_TOKEN), turn))
+
+        if ts is not None:
+            if self.start_time is None or ts < self.start_time:
+                self.start_time = ts
+            if self.end_time is None or ts > self.end_time:
+                self.end_time = ts
+
+        self.total_input += inp
+        self.total_output += out
+        self.total_cache_creation += cache_create
+        self.total_cache_read += cache_read
+
+        if role == ROLE_USER:
+            self.user_messages += 1
+        elif role == ROLE_TOOL_RESULT:
+            self.tool_result_messages += 1
+        elif role == ROLE_ASSISTANT:
+            self._add_turn(inp + cache_create + cache_read, out, tool_uses, model, ts, cache_create, cache_read)
+
+    def _add_turn(self, eff, out, tool_uses, model, ts, cache_create=0, cache_read=0):
+        # eff is the per-turn effective input (the real context window size each turn)
+        series = self.per_turn_effective
+        turn = len(series) + 1
+
+        # Detect compaction events (>50% drop between consecutive turns)
+        compacted = bool(series) and eff < series[-1] * 0.5
+        if compacted:
+            self.compaction_events.append({
+                "turn": turn,
+                "before": series[-1],
+                "after": eff,
+                "reduction_pct": (1 - eff / series[-1]) * 100,
+            })
+        if turn == 1 or eff > self.peak_effective:
+            self.peak_effective = eff
+            self.peak_turn = turn
+        series.append(eff)
+
+        # Results since the last turn are written to the cache now; together they
+        # can't have added more than this turn's cache creation
+        budget = cache_create
+        for i in range(self._uncached_results, len(self._tool_results)):
+            name, tool_id, tokens, arrived = self._tool_results[i]
+            if tokens > budget:
+                self._tool_results[i] = (name, tool_id, budget, arrived)
+                tokens = budget
+            budget -= tokens
+        self._uncached_results = len(self._tool_results)
+
+        self.assistant_output += out
+        self.total_tool_uses += tool_uses
+        if self.model == "unknown" and model:
+            self.model = model
+
+        # Idle gap since the previous turn, and whether this turn rebuilt the cache
+        prev_ts = self.per_turn_time[-1] if self.per_turn_time else math.nan
+        gap = ts - prev_ts if ts is not None and prev_ts == prev_ts else None
+        if gap is not None:
+            bin_index = next(i for i, (bound, _) in enumerate(IDLE_GAP_BINS) if gap < bound)
+            self.idle_gap_counts[bin_index] += 1
+        if turn > 1 and cache_create >= CACHE_REBUILD_MIN_TOKENS and cache_create >= eff * 0.5:
+            if compacted:
+                cause = "compaction"
+            elif gap is not None and gap > CACHE_TTL_SECONDS:
+                cause = "idle expiry"
+            else:
+                cause = "prompt change"
+            # What the rebuild cost over reading the same tokens from cache
+            _, _, price_cache_create, price_cache_read = model_pricing(self.model)
+            cost = cache_create * (price_cache_create - price_cache_read) / 1_000_000
+            self.cache_rebuilds.append({
+                "turn": turn, "gap_seconds": gap, "tokens": cache_create, "cause": cause, "cost": cost,
+            })
+            if gap is not None:
+                self.idle_gap_rebuild_cost[bin_index] += cost
+
+        self.per_turn_output.append(out)
+        self.per_turn_time.append(math.nan if ts is None else ts)
+        self.per_turn_cost.append(self.costs()[-1])
+
+        # Bucket the turn by its own clock hour and model, priced at that model; one
+        # without a timestamp joins the previous turn's hour
+        hour = int(ts // 3600) * 3600 if ts is not None else self._last_hour
+        if hour is not None:
+            key = (hour, model or self.model)
+            price_input, price_output, price_cache_create, price_cache_read = model_pricing(key[1])
+            turn_cost = ((eff - cache_create - cache_read) * price_input + out * price_output
+                         + cache_create * price_cache_create + cache_read * price_cache_read) / 1_000_000
+            bucket = self.hourly.get(key)
+            if bucket is None:
+                bucket = self.hourly[key] = [0, 0, 0, 0, 0.0]
+            bucket[0] += 1
+            bucket[1] += eff
+            bucket[2] += cache_read
+            bucket[3] += out
+            bucket[4] += turn_cost
+            self._last_hour = hour
+
+    @property
+    def cache_hit_rate(self):
+        cache_denominator = self.total_cache_read + self.total_cache_creation + self.total_input
+        return (self.total_cache_read / cache_denominator * 100) if cache_denominator > 0 else 0.0
+
+    def costs(self):
+        """Return (input, output, cache_create, cache_read, total) estimated cost in dollars."""
+        # Pricing per million tokens by model family
+        price_input, price_output, price_cache_create, price_cache_read = model_pricing(self.model)
+
+        cost_input = self.total_input * price_input / 1_000_000
+        cost_output = self.total_output * price_output / 1_000_000
+        cost_cache_create = self.total_cache_creation * price_cache_create / 1_000_000
+        cost_cache_read = self.total_cache_read * price_cache_read / 1_000_000
+        cost_total = cost_input + cost_output + cost_cache_create + cost_cache_read
+        return cost_input, cost_output, cost_cache_create, cost_cache_read, cost_total
+
+    def session_totals(self):
+        """(cache hit rate %, cost) over the main thread and every sub-agent branch, as metrics() adds them up."""
+        parts = (self, *self.subagents.values())
+        cache_read = sum(part.total_cache_read for part in parts)
+        denominator = sum(part.total_cache_read + part.total_cache_creation + part.total_input for part in parts)
+        cost = sum(part.costs()[-1] for part in parts)
+        return (cache_read / denominator * 100 if denominator else 0.0), cost
+
+    def tool_attribution(self, top=5):
+        """Estimate how much context and cost each tool's results added.
+
+        A tool result arriving after turn k is resent as context on every
+        turn from k+1 until the next compaction (or the end of the session).
+        Its size in tokens is estimated from its characters, capped so the
+        results before a turn add up to no more than that turn's cache
+        creation; it is billed once as cache creation and then as a cache
+        read on each later turn. Results whose tool_use was made in another
+        session are counted in unmatched_tool_results and not priced.
+        Returns ({tool name: totals}, top `top` calls by cost), both ordered
+        by cost.
+        """
+        _, _, price_cache_create, price_cache_read = model_pricing(self.model)
+        turn_count = len(self.per_turn_effective)
+        compaction_turns = [evt["turn"] for evt in self.compaction_events]
+        by_tool = {}
+        calls = []
+        for name, tool_id, tokens, arrived in self._tool_results:
+            # First compaction that actually drops this result (not the very next turn's)
+            i = bisect.bisect_right(compaction_turns, arrived + 1)
+            last_turn = compaction_turns[i] - 1 if i < len(compaction_turns) else turn_count
+            carried = max(0, last_turn - arrived)
+            cost = tokens * (price_cache_create + (carried - 1) * price_cache_read) / 1_000_000 if carried else 0.0
+            totals = by_tool.get(name)
+            if totals is None:
+                totals = by_tool[name] = [0, 0, 0, 0.0]
+            totals[0] += 1
+            totals[1] += tokens
+            totals[2] += tokens * carried
+            totals[3] += cost
+            calls.append((cost, name, tool_id, arrived + 1, tokens, carried))
+        by_tool = {
+            name: {"calls": n, "result_tokens": tokens, "context_tokens": context, "cost": cost}
+            for name, (n, tokens, context, cost) in sorted(by_tool.items(), key=lambda x: x[1][3], reverse=True)
+        }
+        top_calls = [
+            {"tool": name, "tool_use_id": tool_id, "turn": turn, "result_tokens": tokens,
+             "turns_carried": carried, "context_tokens": tokens * carried, "cost": cost}
+            for cost, name, tool_id, turn, tokens, carried in heapq.nlargest(top, calls, key=lambda c: c[0])
+        ]
+        return by_tool, top_calls
+
+    def metrics(self, file_path):
+        """Return the metrics dict for the messages consumed so far."""
+        # Derive project name from path
+        # Path is like ~/.claude/projects/-home-user-project/session.jsonl
+        file_path = Path(file_path)
+        project_dir = file_path.parent.name
+
+        start_time = to_datetime(self.start_time)
+        end_time = to_datetime(self.end_time)
+        duration = (end_time - start_time) if (start_time and end_time) else None
+
+        total_input = self.total_input
+        total_output = self.total_output
+        total_cache_creation = self.total_cache_creation
+        total_cache_read = self.total_cache_read
+
+        # Effective input tokens
+        effective_input = total_input + total_cache_creation + total_cache_read
+
+        # Cache hit rate
+        cache_hit_rate = self.cache_hit_rate
+
+        # Turn count (assistant messages = API calls)
+        per_turn_effective = self.per_turn_effective
+        turn_count = len(per_turn_effective)
+
+        # Tokens per turn (using effective input, not raw input_tokens)
+        avg_effective_per_turn = effective_input / turn_count if turn_count > 0 else 0
+        avg_output_per_turn = self.assistant_output / turn_count if turn_count > 0 else 0
+
+        # Tool-to-turn ratio
+        tool_to_turn = self.total_tool_uses / turn_count if turn_count > 0 else 0.0
+
+        # Context growth curve (using effective input per turn)
+        if per_turn_effective:
+            first_effective = per_turn_effective[0]
+            mid_effective = per_turn_effective[len(per_turn_effective) // 2]
+            last_effective = per_turn_effective[-1]
+        else:
+            first_effective = mid_effective = last_effective = 0
+
+        # Context growth: use peak vs first to capture growth before compaction
+        context_growth = self.peak_effective / first_effective if first_effective > 0 else 0.0
+
+        cost_input, cost_output, cost_cache_create, cost_cache_read, cost_total = self.costs()
+        tool_attribution, top_tool_calls = self.tool_attribution()
+        rebuild_cost_by_cause = {}
+        for rebuild in self.cache_rebuilds:
+            rebuild_cost_by_cause[rebuild["cause"]] = rebuild_cost_by_cause.get(rebuild["cause"], 0.0) + rebuild["cost"]
+
+        metrics = {
+            "file_path": str(file_path),
+            "project_dir": project_dir,
+            "model": self.model,
+            "command": self.command or "",
+            "start_time": start_time,
+            "end_time": end_time,
+            "duration": duration,
+            "total_input": total_input,
+            "total_output": total_output,
+            "total_cache_creation": total_cache_creation,
+            "total_cache_read": total_cache_read,
+            "effective_input": effective_input,
+            "cache_hit_rate": cache_hit_rate,
+            "turn_count": turn_count,
+            "avg_effective_per_turn": avg_effective_per_turn,
+            "avg_output_per_turn": avg_output_per_turn,
+            "total_tool_uses": self.total_tool_uses,
+            "tool_to_turn": tool_to_turn,
+            "tool_attribution": tool_attribution,
+            "top_tool_calls": top_tool_calls,
+            "unmatched_tool_results": self.unmatched_tool_results,
+            "first_effective": first_effective,
+            "mid_effective": mid_effective,
+            "last_effective": last_effective,
+            "peak_effective": self.peak_effective,
+            "peak_turn": self.peak_turn,
+            "context_growth": context_growth,
+            "compaction_events": list(self.compaction_events),
+            "cache_rebuilds": list(self.cache_rebuilds),
+            "cache_rebuild_count": len(self.cache_rebuilds),
+            "cache_rebuild_cost": sum(rebuild_cost_by_cause.values()),
+            "cache_rebuild_cost_by_cause": rebuild_cost_by_cause,
+            "idle_gap_histogram": {
+                label: {"turns": count, "rebuild_cost": cost}
+                for (_, label), count, cost in zip(IDLE_GAP_BINS, self.idle_gap_counts, self.idle_gap_rebuild_cost)
+            },
+            "hourly": [[hour, model, *bucket] for (hour, model), bucket in sorted(self.hourly.items())],
+            "per_turn_effective": array("q", per_turn_effective),
+            "per_turn_output": array("q", self.per_turn_output),
+            "per_turn_time": array("d", self.per_turn_time),
+            "per_turn_cost": array("d", self.per_turn_cost),
+            "cost_input": cost_input,
+            "cost_output": cost_output,
+            "cost_cache_create": cost_cache_create,
+            "cost_cache_read": cost_cache_read,
+            "cost_total": cost_total,
+            "total_messages": self.total_messages,
+            "user_messages": self.user_messages,
+            "tool_result_messages": self.tool_result_messages,
+            "assistant_messages": turn_count,
+            "duplicate_messages": self.duplicate_messages,
+            "main_cost": cost_total,
+            "delegated_cost": 0.0,
+            "subagent_turns": 0,
+            "subagents": [],
+        }
+        if self.subagents:
+            self._add_subagents(metrics)
+        return metrics
+
+    def _add_subagents(self, metrics):
+        """Fold the sub-agent branches into a main-thread metrics dict."""
+        hourly = {(hour, model): bucket for hour, model, *bucket in metrics["hourly"]}
+        for key, branch in self.subagents.items():
+            costs = branch.costs()
+            turns = len(branch.per_turn_effective)
+            effective = branch.total_input + branch.total_cache_creation + branch.total_cache_read
+            metrics["subagents"].append({
+                "agent": key, "model": branch.model, "spawned_at_turn": branch.spawned_at_turn,
+                "turns": turns, "effective_input": effective, "output": branch.total_output,
+                "peak_effective": branch.peak_effective, "tool_uses": branch.total_tool_uses,
+                "cache_hit_rate": branch.cache_hit_rate, "cost": costs[-1],
+            })
+            for field, value in (
+                ("total_input", branch.total_input), ("total_output", branch.total_output),
+                ("total_cache_creation", branch.total_cache_creation), ("total_cache_read", branch.total_cache_read),
+                ("effective_input", effective), ("cost_input", costs[0]), ("cost_output", costs[1]),
+                ("cost_cache_create", costs[2]), ("cost_cache_read", costs[3]), ("cost_total", costs[4]),
+                ("delegated_cost", costs[4]), ("subagent_turns", turns), ("assistant_messages", turns),
+                ("total_messages", branch.total_messages), ("user_messages", branch.user_messages),
+                ("tool_result_messages", branch.tool_result_messages),
+                ("unmatched_tool_results", branch.unmatched_tool_results),
+            ):
+                metrics[field] += value
+            for key, bucket in branch.hourly.items():
+                mine = hourly.setdefault(key, [0, 0, 0, 0, 0.0])
+                for i, value in enumerate(bucket):
+                    mine[i] += value
+        metrics["subagents"].sort(key=lambda b: b["cost"], reverse=True)
+        denominator = metrics["effective_input"]
+        metrics["cache_hit_rate"] = metrics["total_cache_read"] / denominator * 100 if denominator else 0.0
+        metrics["hourly"] = [[hour, model, *bucket] for (hour, model), bucket in sorted(hourly.items())]
+
+
+def compute_session_metrics(file_path, messages):
+    """Compute all metrics for a single session from its parsed messages."""
+    acc = SessionAccumulator()
+    for msg in messages:
+        acc.add(msg)
+    return acc.metrics(file_path)
+
+
+# Snapshot layout: header, metadata JSON padded to 8 bytes, the per-turn
+# columns back to back as little-endian arrays (SNAPSHOT_COLUMNS order), then
+# the 64-bit keys of the messages the session counted, for de-duplication
+SNAPSHOT_MAGIC = b"CCSNAP\x00\x00"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<8sIIQQ")  # magic, version, turn count, metadata bytes, message keys
+SNAPSHOT_COLUMNS = (("per_turn_effective", "q"), ("per_turn_output", "q"),
+                    ("per_turn_time", "d"), ("per_turn_cost", "d"))
+
+
+def write_snapshot(metrics, path):
+    """Write one session's metrics as a binary snapshot; returns the bytes written.
+
+    Everything but the per-turn series goes into a small JSON metadata block;
+    the series are written as raw fixed-width columns, so loading them is a
+    memory copy rather than a decode. metrics["message_keys"] (see
+    analyse_session's collect_keys) is stored too, so loading the snapshot
+    can de-duplicate against other sessions. The source path is stored
+    absolute, so the snapshot can find its log from any working directory.
+    """
+    skip = {*dict(SNAPSHOT_COLUMNS), "profile", "message_keys"}
+    meta = {k: v for k, v in metrics.items() if k not in skip}
+    meta["file_path"] = os.path.abspath(meta["file_path"])
+    for key in ("start_time", "end_time"):
+        meta[key] = meta[key].isoformat() if meta[key] is not None else None
+    meta["duration"] = meta["duration"].total_seconds() if meta["duration"] is not None else None
+    meta_bytes = json.dumps(meta, separators=(",", ":")).encode()
+    meta_bytes += b" " * (-len(meta_bytes) % 8)
+    turns = len(metrics["per_turn_effective"])
+    keys = array("q", metrics.get("message_keys", ()))
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, turns, len(meta_bytes), len(keys)))
+        f.write(meta_bytes)
+        for column in [array(typecode, metrics[key]) for key, typecode in SNAPSHOT_COLUMNS] + [keys]:
+            if sys.byteorder == "big":
+                column.byteswap()
+            column.tofile(f)
+    os.replace(tmp, path)
+    return path.stat().st_size
+
+
+def load_snapshot(path):
+    """Load a snapshot written by write_snapshot() back into a metrics dict, via mmap.
+
+    The session's message keys come back in metrics["message_keys"].
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, version, turns, meta_len, key_count = SNAPSHOT_HEADER.unpack_from(mm)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} session snapshot")
+        offset = SNAPSHOT_HEADER.size
+        metrics = json.loads(mm[offset:offset + meta_len])
+        offset += meta_len
+        view = memoryview(mm)
+        columns = [(key, typecode, turns) for key, typecode in SNAPSHOT_COLUMNS]
+        try:
+            for key, typecode, count in columns + [("message_keys", "q", key_count)]:
+                column = array(typecode)
+                size = count * column.itemsize
+                column.frombytes(view[offset:offset + size])
+                if sys.byteorder == "big":
+                    column.byteswap()
+                metrics[key] = column
+                offset += size
+        finally:
+            view.release()
+    for key in ("start_time", "end_time"):
+        metrics[key] = datetime.fromisoformat(metrics[key]) if metrics[key] is not None else None
+    metrics["duration"] = timedelta(seconds=metrics["duration"]) if metrics["duration"] is not None else None
+    return metrics
+
+
+def archive_sessions(results, out_dir):
+    """Write a snapshot per analysed session to out_dir/<project>/<file name>.ccsnap.
+
+    The snapshot is named after the whole source file name (x.jsonl.ccsnap,
+    x.jsonl.gz.ccsnap), so a log and its compressed rotation don't overwrite
+    each other. Returns (sessions, source bytes, snapshot bytes).
+    """
+    out_dir = Path(out_dir).expanduser()
+    count = source_bytes = snapshot_bytes = 0
+    for file_path, metrics in results:
+        if metrics is None:
+            continue
+        target = out_dir / metrics["project_dir"] / (Path(file_path).name + SNAPSHOT_SUFFIX)
+        snapshot_bytes += write_snapshot(metrics, target)
+        # Keep the source mtime so discovery order and --since/--until behave the same
+        st = os.stat(file_path)
+        os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+        source_bytes += st.st_size
+        count += 1
+    return count, source_bytes, snapshot_bytes
+
+
+def message_key(message_id):
+    """Stable 64-bit key for a message id (str hash() is salted per process, so it can't cross workers)."""
+    return int.from_bytes(hashlib.blake2b(message_id.encode(), digest_size=8).digest(), "little", signed=True)
+
+
+def dedup_id(m):
+    """What identifies a parsed message across files: its API message id, else its entry uuid.
+
+    Assistant messages split over several entries share one API id; user and
+    tool_result entries have none, but a resumed session copies them with
+    their uuid intact.
+    """
+    return m.get("message_id") or m.get("uuid")
+
+
+# Default --all de-duplication capacity: about 18 MB of Bloom filter bits
+FLEET_DEDUP_MESSAGES = 10_000_000
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over 64-bit message keys.
+
+    Memory is set by `capacity` and `error_rate` up front (about 1.8 bytes per
+    message at 0.1%) instead of growing with the run like a set. A false
+    positive drops a message that wasn't a duplicate, so totals can be
+    slightly low, never high.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: the two halves of the 64-bit key generate every probe
+        h1 = key & 0xFFFFFFFF
+        h2 = (key >> 32) & 0xFFFFFFFF | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+def analyse_session(file_path, cache=None, profile=False, seen=None, collect_keys=False, where=None):
+    """Stream one session file into an accumulator and return its metrics, or None if it has no messages.
+
+    With profile, the metrics carry a "profile" dict of wall time and ReadStats counters.
+
+    `seen` (a set or BloomFilter of message keys from earlier files) drops
+    messages already counted elsewhere; this file's keys are added to it
+    afterwards, so repeats within the file itself are left alone. Sub-agent
+    transcripts in <session-id>/subagents/ are read as branches of the
+    session (see SessionAccumulator). With
+    collect_keys, the file's keys are returned in metrics["message_keys"]
+    for a parent process to de-duplicate against.
+
+    A .ccsnap snapshot carries the keys of the messages it counted. One that
+    overlaps `seen` is re-analysed from its source log while that still
+    exists; otherwise a snapshot whose messages were all counted already is
+    skipped, and a partly overlapping one is counted in full with a warning.
+
+    A SessionFilter `where` returns None without decoding a file whose raw
+    bytes lack a required model/command value, and stops reading as soon as
+    the session's model fails a model term. Those files add no keys to
+    `seen`: like files pruned by project or date terms, they don't take part
+    in de-duplication, so a message copied from one of them counts in the
+    matching session that repeats it. Metric terms are left to the caller
+    (see analyse_sessions), so files failing only those do add their keys.
+    """
+    start = time.perf_counter()
+    if where is not None and not where.may_match_file(file_path):
+        return None
+    if str(file_path).endswith(SNAPSHOT_SUFFIX):
+        metrics = load_snapshot(file_path)
+        keys = metrics.pop("message_keys")
+        if seen is not None:
+            # A snapshot's totals can't drop single messages: re-analyse the
+            # source log if it overlaps an earlier session, skip a full copy
+            repeated = sum(1 for key in keys if key in seen)
+            if repeated:
+                source = Path(metrics["file_path"])
+                if source.exists() and not str(source).endswith(SNAPSHOT_SUFFIX):
+                    return analyse_session(source, cache, profile, seen, collect_keys, where)
+                if repeated == len(keys):
+                    return None
+                print(f"  Warning: {file_path} repeats {repeated} message(s) counted in an earlier session "
+                      f"and its source log is gone; counting it in full.", file=sys.stderr)
+            seen.update(keys)
+        if collect_keys:
+            metrics["message_keys"] = keys
+        if profile:
+            metrics["profile"] = {"seconds": time.perf_counter() - start, **ReadStats().as_dict(),
+                                  "bytes_read": os.path.getsize(file_path)}
+        return metrics
+    stats = ReadStats()
+    acc = SessionAccumulator()
+    track = seen is not None or collect_keys
+    check_model = where is not None and where.has_model_terms
+    keys = set()
+
+    def consume(messages):
+        nonlocal check_model
+        for m in messages:
+            ident = dedup_id(m) if track else None
+            if ident:
+                key = message_key(ident)
+                if seen is not None and key in seen:
+                    acc.duplicate_messages += 1
+                    continue
+                keys.add(key)
+            acc.add(m)
+            if check_model and acc.model != "unknown":
+                if not where.match_model(acc.model):
+                    return False
+                check_model = False
+        return True
+
+    if not consume(cache.iter_messages(file_path, stats) if cache else SessionReader(file_path, stats=stats)):
+        return None
+    # Sub-agent transcripts stored beside the session are branches of it
+    for sub_path in subagent_files(file_path):
+        agent = session_id(sub_path)
+        messages = cache.iter_messages(sub_path, stats) if cache else SessionReader(sub_path, stats=stats)
+        consume({**m, "is_sidechain": True, "agent_id": m.get("agent_id") or agent} for m in messages)
+    if seen is not None:
+        seen.update(keys)
+    if not acc.message_count:
+        return None
+    metrics = acc.metrics(file_path)
+    if collect_keys:
+        metrics["message_keys"] = array("q", keys)
+    if profile:
+        metrics["profile"] = {"seconds": time.perf_counter() - start, **stats.as_dict()}
+    return metrics
+
+
+# Per-process parse cache for --jobs workers (sqlite connections can't be pickled)
+_worker_cache = None
+
+
+def _init_worker(cache_path):
+    global _worker_cache
+    if cache_path is not None:
+        try:
+            _worker_cache = ParseCache(cache_path)
+        except (sqlite3.Error, OSError):
+            _worker_cache = None
+
+
+def _analyse_batch_in_worker(file_paths, profile=False, collect_keys=False, where=None):
+    return [analyse_session(file_path, _worker_cache, profile, collect_keys=collect_keys, where=where)
+            for file_path in file_paths]
+
+
+def open_parse_cache(cache_path):
+    """Open the parse cache, or warn and return None if it can't be used."""
+    if cache_path is None:
+        return None
+    try:
+        return ParseCache(cache_path)
+    except (sqlite3.Error, OSError) as e:
+        print(f"  Warning: parse cache unavailable ({e}), parsing without it.", file=sys.stderr)
+        return None
+
+
+def analyse_sessions(session_files, cache_path=None, jobs=1, profile=False, seen=None, where=None, collect_keys=False):
+    """Yield (file_path, metrics) in input order, fanning out to a process pool when jobs > 1.
+
+    session_files may be any iterable. Workers get files in batches with at
+    most 2 * jobs batches in flight, so a lazy iterable is never
+    materialised, and return only metrics dicts, never parsed messages.
+
+    With `seen` (see analyse_session), messages are de-duplicated across
+    files with first-seen attribution in input order. Workers can't share
+    the set, so they return each file's message keys; the parent checks
+    them against `seen` and re-analyses (from the parse cache) only the
+    files that really overlap an earlier one.
+
+    Sessions that fail a SessionFilter `where` are yielded with None metrics.
+    With collect_keys, each metrics dict keeps the keys of the messages its
+    file counted in metrics["message_keys"] (see analyse_session).
+    """
+    if jobs <= 1 or (isinstance(session_files, list) and len(session_files) <= 1):
+        cache = open_parse_cache(cache_path)
+        try:
+            for file_path in session_files:
+                metrics = analyse_session(file_path, cache, profile, seen, collect_keys, where)
+                if where is not None and metrics is not None and not where.matches(metrics):
+                    metrics = None
+                yield file_path, metrics
+        finally:
+            if cache:
+                cache.close()
+        return
+
+    if isinstance(session_files, list):
+        batch_size = max(1, len(session_files) // (jobs * 4))
+    else:
+        batch_size = 16
+    batches = iter(lambda it=iter(session_files): list(itertools.islice(it, batch_size)), [])
+    parent_cache = None
+    try:
+        with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker, initargs=(cache_path,)
+        ) as pool:
+            pending = deque()
+            for batch in itertools.chain(batches, [None]):
+                if batch is not None:
+                    pending.append((batch, pool.submit(
+                        _analyse_batch_in_worker, batch, profile, seen is not None or collect_keys, where)))
+                while pending and (batch is None or len(pending) >= jobs * 2):
+                    files, future = pending.popleft()
+                    for file_path, metrics in zip(files, future.result()):
+                        if seen is not None and metrics is not None:
+                            keys = metrics["message_keys"] if collect_keys else metrics.pop("message_keys")
+                            if any(key in seen for key in keys):
+                                if parent_cache is None:
+                                    parent_cache = open_parse_cache(cache_path) or False
+                                metrics = analyse_session(file_path, parent_cache or None, profile, seen,
+                                                          collect_keys, where)
+                            else:
+                                seen.update(keys)
+                        if where is not None and metrics is not None and not where.matches(metrics):
+                            metrics = None
+                        yield file_path, metrics
+    finally:
+        if parent_cache:
+            parent_cache.close()
+
+
+class RunProfile:
+    """Per-phase wall-clock timings and per-file read counters for --profile.
+
+    Timing a phase is two perf_counter() calls; per-file counters come from
+    the ReadStats every SessionReader keeps anyway, so profiling adds almost
+    nothing to the run it measures. Counters are summed as files arrive and
+    only the `keep` slowest files are held, so profiling --all stays flat.
+    """
+
+    def __init__(self, keep=10):
+        self.phases = []
+        self.keep = keep
+        self.file_count = 0
+        self.parse_seconds = 0.0
+        self.totals = ReadStats()
+        self.slowest = []  # min-heap of (seconds, sequence, file_path, profile)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def add_file(self, metrics):
+        if metrics and "profile" in metrics:
+            self.add_profile(metrics["file_path"], metrics["profile"])
+
+    def add_profile(self, file_path, p):
+        self.file_count += 1
+        self.parse_seconds += p["seconds"]
+        for name in ReadStats.__slots__:
+            setattr(self.totals, name, getattr(self.totals, name) + p[name])
+        item = (p["seconds"], self.file_count, file_path, p)
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, item)
+        elif item[0] > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def track(self, results):
+        """Pass (file_path, metrics) results through, recording each file's profile."""
+        for file_path, metrics in results:
+            self.add_file(metrics)
+            yield file_path, metrics
+
+    def print_summary(self, top=10, stream=None):
+        out = stream or sys.stderr
+        total = sum(seconds for _, seconds in self.phases)
+        print(f"\n{'=' * 78}", file=out)
+        print("  PROFILE", file=out)
+        print(f"{'=' * 78}\n", file=out)
+        for name, seconds in self.phases:
+            share = seconds / total * 100 if total else 0.0
+            print(f"  {name:<22} {seconds:>10.3f}s  {share:>5.1f}%", file=out)
+        print(f"  {'total':<22} {total:>10.3f}s", file=out)
+
+        totals, parse_seconds = self.totals, self.parse_seconds
+        mb = totals.bytes_read / (1024 * 1024)
+        print(f"\n  Files:                 {self.file_count:>12,}", file=out)
+        print(f"  Bytes read:            {totals.bytes_read:>12,}  "
+              f"({mb / parse_seconds if parse_seconds else 0:,.1f} MB/s)", file=out)
+        print(f"  Lines decoded:         {totals.lines_decoded:>12,}", file=out)
+        print(f"  Lines skipped (JSON):  {totals.lines_skipped:>12,}", file=out)
+        print(f"  Lines pre-filtered:    {totals.lines_prefiltered:>12,}", file=out)
+        print(f"  Messages kept:         {totals.messages:>12,}", file=out)
+        print(f"  Messages from cache:   {totals.messages_cached:>12,}", file=out)
+
+        if self.slowest:
+            print("\n  --- Slowest Files ---", file=out)
+            print(f"  {'Seconds':>9} {'MB':>8} {'Decoded':>9} {'Skipped':>8} {'Kept':>8} {'Cached':>8}  File",
+                  file=out)
+            for _, _, path, p in sorted(self.slowest, reverse=True)[:top]:
+                print(f"  {p['seconds']:>9.3f} {p['bytes_read'] / (1024 * 1024):>8.1f} "
+                      f"{p['lines_decoded']:>9,} {p['lines_skipped']:>8,} {p['messages']:>8,} "
+                      f"{p['messages_cached']:>8,}  {path}", file=out)
+        print(file=out)
+
+
+@contextmanager
+def cprofile_to(path):
+    """Run the block under cProfile and dump pstats to path (no-op when path is None)."""
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+def group_chains(all_metrics, gap):
+    """Group sessions into workflow chains by project directory and time adjacency.
+
+    Sort-and-sweep: sessions are ordered by (project_dir, start_time) once,
+    then a session joins the current chain if it is in the same project and
+    starts within `gap` (a timedelta) of the chain's latest end time.
+    Sessions without timestamps form single-session chains. Returns chains
+    ordered by start time, each a list of metrics in chronological order.
+    """
+    timed = [m for m in all_metrics if m["start_time"] is not None]
+    untimed = [[m] for m in all_metrics if m["start_time"] is None]
+    timed.sort(key=lambda m: (m["project_dir"], m["start_time"]))
+
+    chains = []
+    chain = None
+    chain_end = None
+    for m in timed:
+        if (chain is not None and m["project_dir"] == chain[0]["project_dir"]
+                and m["start_time"] - chain_end <= gap):
+            chain.append(m)
+            chain_end = max(chain_end, m["end_time"])
+        else:
+            chain = [m]
+            chain_end = m["end_time"]
+            chains.append(chain)
+
+    chains.sort(key=lambda c: c[0]["start_time"])
+    return chains + untimed
+
+
+def summarise_chain(chain):
+    """Totals for one workflow chain (duration is the sum of session durations)."""
+    durations = [m["duration"] for m in chain if m["duration"] is not None]
+    return {
+        "project_dir": chain[0]["project_dir"],
+        "start_time": chain[0]["start_time"],
+        "end_time": max((m["end_time"] for m in chain if m["end_time"]), default=None),
+        "sessions": len(chain),
+        "models": sorted({m["model"] for m in chain}),
+        "duration": sum(durations, timedelta()) if durations else None,
+        "assistant_messages": sum(m["assistant_messages"] for m in chain),
+        "effective_input": sum(m["effective_input"] for m in chain),
+        "peak_effective": max(m["peak_effective"] for m in chain),
+        "cost_total": sum(m["cost_total"] for m in chain),
+    }
+
+
+def phase_label(m, position):
+    """Label a session's phase by its first slash command, else its position in the chain."""
+    return m["command"] or f"phase {position}"
+
+
+def parse_tokens_arg(value):
+    """argparse type for token counts: plain integers or K/M suffixes (80K, 1.5M)."""
+    text = value.strip().upper()
+    scale = {"K": 1_000, "M": 1_000_000}.get(text[-1:], 1)
+    try:
+        tokens = int(float(text[:-1] if scale > 1 else text) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid token count: {value!r} (e.g. 80000 or 80K)")
+    if tokens <= 0:
+        raise argparse.ArgumentTypeError(f"token count must be positive: {value!r}")
+    return tokens
+
+
+def parse_threshold_sweep(value):
+    """argparse type for --sim-thresholds: START:STOP:STEP (inclusive) or a comma list, K/M allowed."""
+    if ":" in value:
+        parts = value.split(":")
+        if len(parts) != 3:
+            raise argparse.ArgumentTypeError(f"invalid sweep: {value!r} (expected START:STOP:STEP)")
+        start, stop, step = (parse_tokens_arg(part) for part in parts)
+        return list(range(start, stop + 1, step))
+    return sorted({parse_tokens_arg(part) for part in value.split(",") if part.strip()})
+
+
+# Compaction policy kinds replayed by CompactionSimulator
+POLICY_RECORDED, POLICY_THRESHOLD, POLICY_EVERY = range(3)
+
+
+def compaction_policies(thresholds=(), every=()):
+    """Build (label, kind, value) policies: as recorded, then each threshold and every-N-turns policy."""
+    policies = [("as recorded", POLICY_RECORDED, 0)]
+    policies += [(f"at {format_tokens(t)}", POLICY_THRESHOLD, t) for t in thresholds]
+    policies += [(f"every {n} turns", POLICY_EVERY, n) for n in every]
+    return policies
+
+
+class CompactionSimulator:
+    """Replay sessions' per-turn context series under alternative compaction policies.
+
+    Works from the metrics already computed for each session (the effective
+    context series, per-turn output and detected compaction events), so
+    nothing is re-parsed. Every policy is advanced together in one pass over
+    each session's turns, and only per-policy totals are kept, so sessions
+    can be streamed through add().
+
+    The replay keeps each turn's context growth from the real session. The
+    compactions that really happened still happen. On top of that, a policy
+    compacts after any turn that reaches its threshold, or after every N
+    turns since the last compaction. The next turn then starts from
+    `post_size` plus that turn's growth. New context is priced as cache
+    creation and carried context as cache reads. Each compaction also pays
+    one call that reads the whole context and writes a `post_size` summary.
+    Output tokens are the same under every policy.
+    """
+
+    def __init__(self, policies, post_size=20_000):
+        self.policies = policies
+        self.post_size = post_size
+        self.sessions = 0
+        n = len(policies)
+        self.costs = [0.0] * n
+        self.compactions = [0] * n
+        self.peak_max = [0] * n
+        self.peak_sum = [0] * n
+
+    def add(self, m):
+        """Replay one session's metrics under every policy."""
+        series = m["per_turn_effective"]
+        if not series:
+            return
+        self.sessions += 1
+        _, price_output, price_cache_create, price_cache_read = model_pricing(m["model"])
+        recorded = {evt["turn"] for evt in m["compaction_events"]}
+        post_size = self.post_size
+        policies = [(kind, value) for _, kind, value in self.policies]
+        n = len(policies)
+        context = [0] * n
+        since = [0] * n  # turns since this policy's last compaction
+        compacted = [False] * n  # compacted after the previous turn
+        peaks = [0] * n
+        cache_create = [0] * n
+        cache_read = [0] * n
+        summaries = [0] * n  # tokens read and written by the policy's own compaction calls
+        counts = [0] * n
+        prev = 0
+        for turn, eff in enumerate(series, 1):
+            delta = eff - prev
+            prev = eff
+            is_recorded = turn in recorded
+            for i in range(n):
+                if is_recorded:
+                    # The real session compacted here; whatever is left is re-cached
+                    ctx = min(context[i], eff)
+                    fresh = ctx
+                    since[i] = 0
+                elif compacted[i]:
+                    ctx = post_size + max(delta, 0)
+                    fresh = ctx
+                else:
+                    ctx = max(context[i] + delta, 0)
+                    fresh = min(max(delta, 0), ctx)
+                compacted[i] = False
+                context[i] = ctx
+                since[i] += 1
+                cache_create[i] += fresh
+                cache_read[i] += ctx - fresh
+                if ctx > peaks[i]:
+                    peaks[i] = ctx
+
+                kind, value = policies[i]
+                if kind != POLICY_RECORDED and ctx > post_size and turn < len(series) and (
+                    (kind == POLICY_THRESHOLD and ctx >= value) or (kind == POLICY_EVERY and since[i] >= value)
+                ):
+                    compacted[i] = True
+                    since[i] = 0
+                    counts[i] += 1
+                    summaries[i] += ctx
+
+        output_cost = sum(m["per_turn_output"]) * price_output
+        for i in range(n):
+            self.costs[i] += (
+                cache_create[i] * price_cache_create + cache_read[i] * price_cache_read
+                + summaries[i] * price_cache_read + counts[i] * post_size * price_output
+                + output_cost
+            ) / 1_000_000
+            self.compactions[i] += counts[i] + len(recorded)
+            self.peak_max[i] = max(self.peak_max[i], peaks[i])
+            self.peak_sum[i] += peaks[i]
+
+    def results(self):
+        """One dict per policy, in policy order, with savings against the as-recorded replay."""
+        baseline = self.costs[0] if self.policies and self.policies[0][1] == POLICY_RECORDED else None
+        out = []
+        for i, (label, kind, value) in enumerate(self.policies):
+            cost = self.costs[i]
+            out.append({
+                "policy": label,
+                "kind": ("recorded", "threshold", "every")[kind],
+                "value": value,
+                "sessions": self.sessions,
+                "compactions": self.compactions[i],
+                "peak_max": self.peak_max[i],
+                "peak_mean": self.peak_sum[i] / self.sessions if self.sessions else 0,
+                "cost": cost,
+                "savings": baseline - cost if baseline is not None else None,
+                "savings_pct": (baseline - cost) / baseline * 100 if baseline else None,
+            })
+        return out
+
+
+class QuantileSketch:
+    """Mergeable streaming quantile sketch with bounded relative error.
+
+    DDSketch-style: each positive value lands in a logarithmic bucket, so any
+    quantile is answered within `relative_accuracy` of the true value. Memory
+    depends on the range of values seen (a few hundred buckets for token
+    counts), not on how many were added, and two sketches merge by adding
+    bucket counts.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value <= 0:
+            self.zero_count += 1
+        else:
+            key = math.ceil(math.log(value) / self.log_gamma)
+            self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("cannot merge sketches with different accuracy")
+        for key, n in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + n
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """Approximate q-quantile (0 <= q <= 1); 0.0 for an empty sketch."""
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                estimate = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(estimate, self.min), self.max)
+        return self.max
+
+
+class TopK:
+    """Keep the k largest (score, item) pairs seen; mergeable."""
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+        self._seq = 0
+
+    def add(self, score, item):
+        # seq breaks ties so items themselves are never compared
+        entry = (score, self._seq, item)
+        self._seq += 1
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif score > self.heap[0][0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def merge(self, other):
+        for score, _, item in other.heap:
+            self.add(score, item)
+
+    def items(self):
+        """(score, item) pairs, largest first."""
+        return [(score, item) for score, _, item in sorted(self.heap, key=lambda e: e[0], reverse=True)]
+
+
+# Per-session metrics summarised into fleet-wide quantile sketches by --all
+FLEET_QUANTILE_METRICS = (
+    ("cost_total", "Cost ($)"),
+    ("assistant_messages", "Turns"),
+    ("peak_effective", "Peak context"),
+    ("cache_hit_rate", "Cache hit %"),
+    ("effective_input", "Eff. input"),
+)
+
+
+class FleetSummary:
+    """Bounded-memory, mergeable summary of many sessions for --all.
+
+    Holds running totals, one QuantileSketch per FLEET_QUANTILE_METRICS entry,
+    a top-K heap of the most expensive sessions and per-project / per-model
+    totals. Nothing per-session is retained beyond the top-K, so memory is
+    flat in the number of sessions, and summaries built by separate workers
+    combine with merge().
+    """
+
+    def __init__(self, top=10):
+        self.top = top
+        self.sessions = 0
+        self.totals = dict.fromkeys(
+            ("effective_input", "total_output", "assistant_messages", "cost_total",
+             "total_cache_read", "total_cache_creation", "total_input", "duplicate_messages",
+             "delegated_cost", "subagent_turns"), 0
+        )
+        self.sessions_with_compaction = 0
+        self.sketches = {key: QuantileSketch() for key, _ in FLEET_QUANTILE_METRICS}
+        self.top_sessions = TopK(top)
+        self.projects = {}
+        self.models = {}
+
+    def add(self, m):
+        self.sessions += 1
+        for key in self.totals:
+            self.totals[key] += m[key]
+        if m["compaction_events"]:
+            self.sessions_with_compaction += 1
+        for key, sketch in self.sketches.items():
+            sketch.add(m[key])
+        self.top_sessions.add(m["cost_total"], {
+            "file_path": m["file_path"], "project_dir": m["project_dir"], "model": m["model"],
+            "start_time": m["start_time"].isoformat() if isinstance(m["start_time"], datetime) else m["start_time"],
+            "assistant_messages": m["assistant_messages"], "peak_effective": m["peak_effective"],
+            "cost_total": m["cost_total"],
+        })
+        for table, key in ((self.projects, m["project_dir"]), (self.models, m["model"])):
+            entry = table.setdefault(key, [0, 0, 0.0])
+            entry[0] += 1
+            entry[1] += m["assistant_messages"]
+            entry[2] += m["cost_total"]
+
+    def merge(self, other):
+        self.sessions += other.sessions
+        for key in self.totals:
+            self.totals[key] += other.totals[key]
+        self.sessions_with_compaction += other.sessions_with_compaction
+        for key, sketch in self.sketches.items():
+            sketch.merge(other.sketches[key])
+        self.top_sessions.merge(other.top_sessions)
+        for mine, theirs in ((self.projects, other.projects), (self.models, other.models)):
+            for key, (count, turns, cost) in theirs.items():
+                entry = mine.setdefault(key, [0, 0, 0.0])
+                entry[0] += count
+                entry[1] += turns
+                entry[2] += cost
+
+    def top_projects(self):
+        return sorted(self.projects.items(), key=lambda x: x[1][2], reverse=True)[:self.top]
+
+    def as_dict(self, quantiles=(0.5, 0.9, 0.99)):
+        return {
+            "sessions": self.sessions,
+            "totals": dict(self.totals),
+            "sessions_with_compaction": self.sessions_with_compaction,
+            "quantiles": {
+                key: {"mean": sketch.mean, "max": sketch.max if sketch.count else 0,
+                      **{f"p{round(q * 100)}": sketch.quantile(q) for q in quantiles}}
+                for key, sketch in self.sketches.items()
+            },
+            "top_sessions": [item for _, item in self.top_sessions.items()],
+            "top_projects": [
+                {"project_dir": name, "sessions": count, "turns": turns, "cost_total": cost}
+                for name, (count, turns, cost) in self.top_projects()
+            ],
+            "models": {
+                name: {"sessions": count, "turns": turns, "cost_total": cost}
+                for name, (count, turns, cost) in self.models.items()
+            },
+        }
+
+
+def _summarise_in_worker(file_paths, top, where=None, collect_keys=False, drop=None, profile=False):
+    """Summarise a batch of files; with collect_keys also return each file's message keys (None if skipped).
+
+    `drop` maps a file's position in the batch to message keys the parent
+    found in earlier files, which are left out of that file's metrics. With
+    profile, the third item lists (file_path, profile dict) per analysed file.
+    """
+    summary = FleetSummary(top)
+    keys = []
+    profiles = []
+    for i, file_path in enumerate(file_paths):
+        seen = set(drop[i]) if drop and i in drop else None
+        metrics = analyse_session(file_path, _worker_cache, profile, seen, collect_keys, where)
+        keys.append(metrics.pop("message_keys") if collect_keys and metrics is not None else None)
+        if metrics is not None and "profile" in metrics:
+            profiles.append((metrics["file_path"], metrics.pop("profile")))
+        if metrics is not None and (where is None or where.matches(metrics)):
+            summary.add(metrics)
+    return summary, keys, profiles
+
+
+def summarise_fleet(paths, cache_path=None, jobs=1, top=10, batch_size=64, seen=None, where=None, profile=None):
+    """Stream every session in `paths` (any iterable) into one FleetSummary.
+
+    With jobs > 1 each worker summarises a batch of files and the parent
+    merges the partial summaries; at most 2 * jobs batches are in flight, so
+    neither the path list nor per-session metrics pile up in memory.
+
+    With `seen`, `paths` should run oldest first: a message copied into
+    several files counts in the oldest. Workers also return each file's
+    message keys, which the parent checks against `seen` batch by batch in
+    input order. A batch with no overlap is merged as it is; one that has
+    overlap goes back to a worker with the keys to drop from each
+    overlapping file, and that summary is merged instead.
+
+    With a RunProfile `profile`, each file's read counters are added to it
+    as its batch comes back (for a re-summarised batch, those of the rerun).
+    """
+    summary = FleetSummary(top)
+    if jobs <= 1:
+        for _, metrics in analyse_sessions(paths, cache_path, jobs, profile is not None, seen, where):
+            if metrics is not None:
+                if profile is not None:
+                    profile.add_file(metrics)
+                summary.add(metrics)
+        return summary
+
+    dedup = seen is not None
+    batches = iter(lambda it=iter(paths): list(itertools.islice(it, batch_size)), [])
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker, initargs=(cache_path,)
+    ) as pool:
+        pending = deque()
+        for batch in itertools.chain(batches, [None]):
+            if batch is not None:
+                pending.append((batch, pool.submit(
+                    _summarise_in_worker, batch, top, where, dedup, None, profile is not None)))
+            while pending and (batch is None or len(pending) >= jobs * 2):
+                files, future = pending.popleft()
+                partial, batch_keys, profiles = future.result()
+                drop = {}
+                for i, keys in enumerate(batch_keys):
+                    if keys is None:
+                        continue
+                    duplicates = [key for key in keys if key in seen]
+                    if duplicates:
+                        drop[i] = duplicates
+                    seen.update(keys)
+                if drop:
+                    # Already checked; the re-summarised batch comes back without keys
+                    pending.append((files, pool.submit(
+                        _summarise_in_worker, files, top, where, False, drop, profile is not None)))
+                else:
+                    summary.merge(partial)
+                    if profile is not None:
+                        for file_path, p in profiles:
+                            profile.add_profile(file_path, p)
+    return summary
+
+
+# Per-session metrics --compare tests for a change between two session sets
+COMPARE_METRICS = (
+    ("cost_total", "Cost ($)"),
+    ("assistant_messages", "Turns"),
+    ("peak_effective", "Peak context"),
+    ("effective_input", "Eff. input"),
+    ("cache_hit_rate", "Cache hit %"),
+    ("cache_rebuild_cost", "Rebuild ($)"),
+)
+
+
+def compare_samples(results):
+    """Collect the COMPARE_METRICS values of (file_path, metrics) results: ({metric: array}, sessions)."""
+    samples = {key: array("d") for key, _ in COMPARE_METRICS}
+    count = 0
+    for _, metrics in results:
+        if metrics is None:
+            continue
+        count += 1
+        for key, column in samples.items():
+            column.append(metrics[key])
+    return samples, count
+
+
+def _median(values):
+    ordered = sorted(values)
+    mid = len(ordered) // 2
+    return ordered[mid] if len(ordered) % 2 else (ordered[mid - 1] + ordered[mid]) / 2
+
+
+def _sorted_median(ordered, indices):
+    """Median of ordered[i] for a sorted list of indices."""
+    mid = len(indices) // 2
+    if len(indices) % 2:
+        return ordered[indices[mid]]
+    return (ordered[indices[mid - 1]] + ordered[indices[mid]]) / 2
+
+
+def _percentile(ordered, q):
+    """Linearly interpolated q-quantile (0 to 1) of an already sorted list."""
+    pos = (len(ordered) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+
+def _relative_change(before, after):
+    """Percent change from before to after; None when before is zero."""
+    return (after / before - 1) * 100 if before else None
+
+
+def _bootstrap_batch(baseline, candidate, iterations, seed):
+    """Resample both sets `iterations` times; returns {metric: (mean changes, median changes)}.
+
+    Every column is sorted up front and each resample is drawn as a sorted
+    list of indices shared by all metrics, so a resampled column is already
+    in order: its median is one lookup and its mean one sum, with no
+    per-metric sort. Changes are percentages (None where undefined).
+    """
+    rng = random.Random(seed)
+    baseline = {key: sorted(values) for key, values in baseline.items()}
+    candidate = {key: sorted(values) for key, values in candidate.items()}
+    n_base = len(baseline[COMPARE_METRICS[0][0]])
+    n_cand = len(candidate[COMPARE_METRICS[0][0]])
+    base_range, cand_range = range(n_base), range(n_cand)
+    changes = {key: ([], []) for key, _ in COMPARE_METRICS}
+    for _ in range(iterations):
+        base_idx = sorted(rng.choices(base_range, k=n_base))
+        cand_idx = sorted(rng.choices(cand_range, k=n_cand))
+        for key, (means, medians) in changes.items():
+            before, after = baseline[key], candidate[key]
+            means.append(_relative_change(sum(map(before.__getitem__, base_idx)) / n_base,
+                                          sum(map(after.__getitem__, cand_idx)) / n_cand))
+            medians.append(_relative_change(_sorted_median(before, base_idx), _sorted_median(after, cand_idx)))
+    return changes
+
+
+def bootstrap_compare(baseline, candidate, iterations=2000, jobs=1, seed=0, confidence=0.95, batch_size=250):
+    """Compare two session sets metric by metric with percentile bootstrap confidence intervals.
+
+    baseline/candidate are compare_samples() columns. Returns one dict per
+    COMPARE_METRICS entry with both sets' mean and median, the candidate's
+    percent change from the baseline and its confidence interval. Resamples
+    run in fixed-size batches seeded from `seed` and the batch number,
+    across a process pool when jobs > 1, so results don't depend on `jobs`.
+    """
+    sizes = [min(batch_size, iterations - start) for start in range(0, iterations, batch_size)]
+    seeds = [seed * 1_000_003 + n for n in range(len(sizes))]
+    if jobs > 1 and len(sizes) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            parts = list(pool.map(_bootstrap_batch, itertools.repeat(baseline), itertools.repeat(candidate),
+                                  sizes, seeds))
+    else:
+        parts = [_bootstrap_batch(baseline, candidate, size, batch_seed) for size, batch_seed in zip(sizes, seeds)]
+
+    alpha = (1 - confidence) / 2
+    results = []
+    for key, label in COMPARE_METRICS:
+        row = {"metric": key, "label": label}
+        for index, (stat, func) in enumerate((("mean", lambda v: sum(v) / len(v)), ("median", _median))):
+            samples = sorted(x for part in parts for x in part[key][index] if x is not None)
+            ci = [_percentile(samples, alpha), _percentile(samples, 1 - alpha)] if samples else None
+            row[f"baseline_{stat}"] = func(baseline[key])
+            row[f"candidate_{stat}"] = func(candidate[key])
+            row[f"{stat}_change_pct"] = _relative_change(row[f"baseline_{stat}"], row[f"candidate_{stat}"])
+            row[f"{stat}_ci"] = ci
+            row[f"{stat}_significant"] = ci is not None and (ci[0] > 0 or ci[1] < 0)
+        results.append(row)
+    return results
+
+
+class _OwnedKeys:
+    """`seen` for analyse_session() backed by RollupStore.message_keys.
+
+    A message key counts as already seen when another source file was the
+    first to count it, in this run or any earlier one.
+    """
+
+    def __init__(self, conn, source_id):
+        self.conn = conn
+        self.source_id = source_id
+
+    def __contains__(self, key):
+        row = self.conn.execute("SELECT source_id FROM message_keys WHERE key = ?", (key,)).fetchone()
+        return row is not None and row[0] != self.source_id
+
+    def update(self, keys):
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO message_keys (key, source_id) VALUES (?, ?)",
+            ((key, self.source_id) for key in keys),
+        )
+
+
+class RollupStore:
+    """On-disk SQLite rollups of assistant turns into hourly (project, model) buckets.
+
+    Each session file's per-hour, per-model contribution is stored next to
+    the bucket totals; a turn counts under its own model. When a file is
+    new or its size/mtime changed, its old contributions are subtracted
+    from the buckets they touched and the new ones added, so only those
+    buckets are rewritten; files that disappear keep their history. Day,
+    week and month tables are summed from the hour buckets at query time,
+    so a year of history is at most 8,760 rows per (project, model) pair,
+    however many log lines it came from.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sources (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            project TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS contributions (
+            source_id INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            turns INTEGER NOT NULL,
+            effective INTEGER NOT NULL,
+            cache_read INTEGER NOT NULL,
+            output INTEGER NOT NULL,
+            cost REAL NOT NULL,
+            PRIMARY KEY (source_id, hour, model)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS buckets (
+            hour INTEGER NOT NULL,
+            project TEXT NOT NULL,
+            model TEXT NOT NULL,
+            files INTEGER NOT NULL,
+            turns INTEGER NOT NULL,
+            effective INTEGER NOT NULL,
+            cache_read INTEGER NOT NULL,
+            output INTEGER NOT NULL,
+            cost REAL NOT NULL,
+            PRIMARY KEY (hour, project, model)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS message_keys (
+            key INTEGER PRIMARY KEY,
+            source_id INTEGER NOT NULL
+        );
+    """
+
+    # Bump when the schema or stored field meaning changes; old rollups are rebuilt
+    SCHEMA_VERSION = 1
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.db_path), timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            self.conn.executescript(
+                "DROP TABLE IF EXISTS message_keys; DROP TABLE IF EXISTS buckets; "
+                "DROP TABLE IF EXISTS contributions; DROP TABLE IF EXISTS sources;"
+            )
+            self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def update(self, entries, cache=None, dedup=True):
+        """Fold new and changed session files into the buckets; returns (files analysed, buckets touched).
+
+        `entries` are (mtime, path, stat_result) tuples as yielded by
+        iter_session_entries(with_stat=True). Changed files are analysed
+        oldest first, one transaction each. With dedup, a message copied
+        into a resumed or forked session stays with whichever file counted
+        it first, across runs as well as within one.
+        """
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in
+                 self.conn.execute("SELECT path, size, mtime_ns FROM sources")}
+        signatures = ((mtime, path, session_signature(path, st)) for mtime, path, st in entries)
+        changed = [entry for entry in signatures if known.get(str(entry[1])) != entry[2]]
+        changed.sort(key=lambda e: e[0])
+        touched = set()
+        for _, path, signature in changed:
+            with self.conn:
+                touched |= self._replace(path, signature, cache, dedup)
+        return len(changed), len(touched)
+
+    def _replace(self, path, signature, cache, dedup):
+        row = self.conn.execute("SELECT id, project FROM sources WHERE path = ?", (str(path),)).fetchone()
+        touched = set()
+        if row is None:
+            source_id = self.conn.execute(
+                "INSERT INTO sources (path, size, mtime_ns, project) VALUES (?, 0, 0, '')",
+                (str(path),),
+            ).lastrowid
+        else:
+            source_id, project = row
+            old = self.conn.execute(
+                "SELECT hour, model, turns, effective, cache_read, output, cost FROM contributions "
+                "WHERE source_id = ?",
+                (source_id,),
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE buckets SET files = files - 1, turns = turns - ?, effective = effective - ?, "
+                "cache_read = cache_read - ?, output = output - ?, cost = cost - ? "
+                "WHERE hour = ? AND project = ? AND model = ?",
+                ((*values, hour, project, model) for hour, model, *values in old),
+            )
+            self.conn.execute("DELETE FROM contributions WHERE source_id = ?", (source_id,))
+            touched.update((hour, project, model) for hour, model, *_ in old)
+
+        metrics = analyse_session(path, cache, seen=_OwnedKeys(self.conn, source_id) if dedup else None)
+        project = metrics["project_dir"] if metrics else Path(path).parent.name
+        # One row per (hour, model): a mid-session model switch or a sub-agent on
+        # another model lands in that model's bucket
+        hourly = metrics.get("hourly", []) if metrics else []
+        self.conn.executemany(
+            "INSERT INTO contributions (source_id, hour, model, turns, effective, cache_read, output, cost) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((source_id, *bucket) for bucket in hourly),
+        )
+        self.conn.executemany(
+            "INSERT INTO buckets (hour, project, model, files, turns, effective, cache_read, output, cost) "
+            "VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?) ON CONFLICT (hour, project, model) DO UPDATE SET "
+            "files = files + 1, turns = turns + excluded.turns, effective = effective + excluded.effective, "
+            "cache_read = cache_read + excluded.cache_read, output = output + excluded.output, "
+            "cost = cost + excluded.cost",
+            ((hour, project, model, *values) for hour, model, *values in hourly),
+        )
+        touched.update((hour, project, model) for hour, model, *_ in hourly)
+        self.conn.executemany(
+            "DELETE FROM buckets WHERE hour = ? AND project = ? AND model = ? AND files <= 0", touched,
+        )
+        self.conn.execute(
+            "UPDATE sources SET size = ?, mtime_ns = ?, project = ? WHERE id = ?",
+            (*signature, project, source_id),
+        )
+        return touched
+
+    def query(self, period="day", by=None, project=None, since=None, until=None):
+        """Return one row dict per `period` bucket, oldest first, split by "project" or "model" if `by` is set.
+
+        `project` keeps projects whose name contains it; `since`/`until`
+        are epoch seconds bounds on the turns' hours.
+        """
+        label = f"strftime('{ROLLUP_PERIODS[period][1]}', hour, 'unixepoch', 'localtime')"
+        group = by or "''"
+        where, params = [], []
+        if project:
+            where.append("instr(project, ?) > 0")
+            params.append(project)
+        if since is not None:
+            where.append("hour > ?")
+            params.append(since - 3600)
+        if until is not None:
+            where.append("hour < ?")
+            params.append(until)
+        rows = self.conn.execute(
+            f"SELECT {label} AS period, {group} AS grp, SUM(turns), SUM(effective), SUM(cache_read), "
+            f"SUM(output), SUM(cost) AS total FROM buckets "
+            f"{'WHERE ' + ' AND '.join(where) if where else ''} "
+            f"GROUP BY period, grp ORDER BY period, total DESC",
+            params,
+        )
+        result = []
+        for period_label, group, turns, effective, cache_read, output, cost in rows:
+            row = {"period": period_label}
+            if by:
+                row[by] = group
+            row.update({
+                "turns": turns, "effective_input": effective, "cache_read": cache_read, "output": output,
+                "cache_hit_rate": cache_read / effective * 100 if effective else 0.0, "cost": cost,
+            })
+            result.append(row)
+        return result
+
+
+class SessionWatcher:
+    """Tail one growing session file, feeding only appended lines into an accumulator.
+
+    Each poll is a stat plus a read of the bytes past the last consumed
+    offset, for the session and for each of its sub-agent transcripts. A
+    file that shrinks (rewritten or truncated) is re-read from the start.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = Path(file_path)
+        self._reset()
+
+    def _reset(self):
+        self.reader = SessionReader(self.file_path)
+        self.sub_readers = {}
+        self.acc = SessionAccumulator()
+
+    def poll(self):
+        """Consume any newly appended lines; returns True if new messages arrived."""
+        try:
+            size = os.stat(self.file_path).st_size
+        except OSError:
+            return False
+        if size < self.reader.offset:
+            self._reset()
+        before = self.acc.message_count
+        if size != self.reader.offset:
+            for msg in self.reader:
+                self.acc.add(msg)
+        for sub_path in subagent_files(self.file_path):
+            reader = self.sub_readers.get(sub_path)
+            try:
+                sub_size = os.stat(sub_path).st_size
+            except OSError:
                 continue
+            if reader is None or sub_size < reader.offset:
+                if reader is not None:
+                    self._reset()
+                    return self.poll()
+                reader = self.sub_readers[sub_path] = SessionReader(sub_path)
+            if sub_size == reader.offset:
+                continue
+            agent = session_id(sub_path)
+            for msg in reader:
+                self.acc.add({**msg, "is_sidechain": True, "agent_id": msg.get("agent_id") or agent})
+        return self.acc.message_count != before
+
+
+def downsample_indices(values, target, keep=()):
+    """Pick at most ~target indices from values, preserving the curve's shape.
+
+    Min/max bucketing: the series is split into target // 2 buckets and each
+    bucket contributes the index of its minimum and its maximum, so peaks and
+    the bottom of every compaction drop survive. First, last and any `keep`
+    indices (e.g. compaction turns and the turn before them) are always included.
+    Returns sorted indices.
+    """
+    n = len(values)
+    if target <= 0 or n <= target:
+        return list(range(n))
+    chosen = {0, n - 1}
+    chosen.update(i for i in keep if 0 <= i < n)
+    buckets = max(1, target // 2)
+    size = n / buckets
+    for b in range(buckets):
+        lo, hi = int(b * size), min(n, int((b + 1) * size))
+        if lo >= hi:
+            continue
+        lo_i = hi_i = lo
+        for i in range(lo + 1, hi):
+            if values[i] < values[lo_i]:
+                lo_i = i
+            elif values[i] > values[hi_i]:
+                hi_i = i
+        chosen.add(lo_i)
+        chosen.add(hi_i)
+    return sorted(chosen)
 
-            # Extract message data
-            msg = entry.get("message")
-            if not msg:
-                continue
 
-            role = msg.get("role", "")
-            usage = msg.get("usage", {})
-            content = msg.get("content", [])
-            timestamp = entry.get("timestamp")
+def compaction_indices(m):
+    """0-based turn indices either side of each compaction drop."""
+    keep = []
+    for evt in m["compaction_events"]:
+        keep += (evt["turn"] - 2, evt["turn"] - 1)
+    return keep
 
-            # Parse timestamp
-            ts = None
-            if timestamp:
-                try:
-                    ts = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
-                except (ValueError, AttributeError):
-                    pass
-
-            # Count tool uses and tool results in content blocks
-            tool_use_count = 0
-            has_tool_result = False
-            has_user_text = False
-            if isinstance(content, list):
-                for block in content:
-                    if isinstance(block, dict):
-                        if block.get("type") == "tool_use":
-                            tool_use_count += 1
-                        elif block.get("type") == "tool_result":
-                            has_tool_result = True
-                        elif block.get("type") == "text" and block.get("text", "").strip():
-                            has_user_text = True
-            elif isinstance(content, str) and content.strip():
-                has_user_text = True
-
-            # Classify user messages: tool_result-only vs real user input
-            is_tool_result_only = (role == "user" and has_tool_result and not has_user_text)
-
-            messages.append({
-                "role": role,
-                "is_tool_result_only": is_tool_result_only,
-                "model": msg.get("model", ""),
-                "input_tokens": usage.get("input_tokens", 0),
-                "output_tokens": usage.get("output_tokens", 0),
-                "cache_creation_input_tokens": usage.get("cache_creation_input_tokens", 0),
-                "cache_read_input_tokens": usage.get("cache_read_input_tokens", 0),
-                "timestamp": ts,
-                "tool_use_count": tool_use_count,
-            })
 
-    return messages
+def turn_series(m, points=0):
+    """Yield per-turn points for a session, optionally downsampled to about `points` turns."""
+    effective = m["per_turn_effective"]
+    indices = downsample_indices(effective, points, compaction_indices(m)) if points else range(len(effective))
+    compaction_turns = {evt["turn"] for evt in m["compaction_events"]}
+    for i in indices:
+        ts = m["per_turn_time"][i]
+        yield {
+            "file_path": m["file_path"],
+            "turn": i + 1,
+            "timestamp": to_datetime(ts).isoformat() if ts == ts else None,
+            "effective_input": effective[i],
+            "output_tokens": m["per_turn_output"][i],
+            "cumulative_cost": round(m["per_turn_cost"][i], 6),
+            "compaction": (i + 1) in compaction_turns,
+        }
 
 
-def compute_session_metrics(file_path, messages):
-    """Compute all metrics for a single session."""
-    # Derive project name from path
-    # Path is like ~/.claude/projects/-home-user-project/session.jsonl
-    project_dir = file_path.parent.name
-
-    # Filter message types
-    assistant_msgs = [m for m in messages if m["role"] == "assistant"]
-    all_user_msgs = [m for m in messages if m["role"] == "user"]
-    real_user_msgs = [m for m in all_user_msgs if not m.get("is_tool_result_only")]
-    tool_result_msgs = [m for m in all_user_msgs if m.get("is_tool_result_only")]
-
-    # Timestamps
-    all_timestamps = [m["timestamp"] for m in messages if m["timestamp"]]
-    start_time = min(all_timestamps) if all_timestamps else None
-    end_time = max(all_timestamps) if all_timestamps else None
-    duration = (end_time - start_time) if (start_time and end_time) else None
-
-    # Total tokens
-    total_input = sum(m["input_tokens"] for m in messages)
-    total_output = sum(m["output_tokens"] for m in messages)
-    total_cache_creation = sum(m["cache_creation_input_tokens"] for m in messages)
-    total_cache_read = sum(m["cache_read_input_tokens"] for m in messages)
-
-    # Effective input tokens
-    effective_input = total_input + total_cache_creation + total_cache_read
-
-    # Cache hit rate
-    cache_denominator = total_cache_read + total_cache_creation + total_input
-    cache_hit_rate = (total_cache_read / cache_denominator * 100) if cache_denominator > 0 else 0.0
-
-    # Turn count (assistant messages = API calls)
-    turn_count = len(assistant_msgs)
-
-    # Per-turn effective input (the real context window size each turn)
-    per_turn_effective = []
-    for m in assistant_msgs:
-        eff = m["input_tokens"] + m["cache_creation_input_tokens"] + m["cache_read_input_tokens"]
-        per_turn_effective.append(eff)
-
-    # Tokens per turn (using effective input, not raw input_tokens)
-    avg_effective_per_turn = effective_input / turn_count if turn_count > 0 else 0
-    assistant_output = sum(m["output_tokens"] for m in assistant_msgs)
-    avg_output_per_turn = assistant_output / turn_count if turn_count > 0 else 0
-
-    # Tool use count
-    total_tool_uses = sum(m["tool_use_count"] for m in assistant_msgs)
-
-    # Tool-to-turn ratio
-    tool_to_turn = total_tool_uses / turn_count if turn_count > 0 else 0.0
-
-    # Context growth curve (using effective input per turn)
-    if per_turn_effective:
-        first_effective = per_turn_effective[0]
-        mid_effective = per_turn_effective[len(per_turn_effective) // 2]
-        last_effective = per_turn_effective[-1]
-        peak_effective = max(per_turn_effective)
-        peak_turn = per_turn_effective.index(peak_effective) + 1
-    else:
-        first_effective = mid_effective = last_effective = peak_effective = 0
-        peak_turn = 0
-
-    # Context growth: use peak vs first to capture growth before compaction
-    context_growth = peak_effective / first_effective if first_effective > 0 else 0.0
-
-    # Detect compaction events (>50% drop between consecutive turns)
-    compaction_events = []
-    for i in range(1, len(per_turn_effective)):
-        if per_turn_effective[i] < per_turn_effective[i - 1] * 0.5:
-            compaction_events.append({
-                "turn": i + 1,
-                "before": per_turn_effective[i - 1],
-                "after": per_turn_effective[i],
-                "reduction_pct": (1 - per_turn_effective[i] / per_turn_effective[i - 1]) * 100,
-            })
+TIMESERIES_FIELDS = (
+    "file_path", "turn", "timestamp", "effective_input", "output_tokens", "cumulative_cost", "compaction",
+)
 
-    # Detect model from assistant messages
-    model = "unknown"
-    for m in assistant_msgs:
-        if m.get("model"):
-            model = m["model"]
-            break
 
-    # Pricing per million tokens by model family
-    if "opus" in model:
-        price_input, price_output = 15.0, 75.0
-        price_cache_create, price_cache_read = 18.75, 1.875
-    elif "haiku" in model:
-        price_input, price_output = 0.80, 4.0
-        price_cache_create, price_cache_read = 1.0, 0.08
-    else:  # sonnet or unknown — use sonnet pricing
-        price_input, price_output = 3.0, 15.0
-        price_cache_create, price_cache_read = 3.75, 0.30
+def write_timeseries(results, fmt, points=0, stream=None):
+    """Stream per-turn rows for each session as ndjson or csv; returns sessions written."""
+    stream = stream or sys.stdout
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(stream, fieldnames=TIMESERIES_FIELDS)
+        writer.writeheader()
+    written = 0
+    for file_path, metrics in results:
+        if metrics is None:
+            print(f"Warning: No messages found in {file_path}, skipping.", file=sys.stderr)
+            continue
+        for row in turn_series(metrics, points):
+            if writer:
+                writer.writerow(row)
+            else:
+                stream.write(json.dumps(row) + "\n")
+        stream.flush()
+        written += 1
+    return written
 
-    cost_input = total_input * price_input / 1_000_000
-    cost_output = total_output * price_output / 1_000_000
-    cost_cache_create = total_cache_creation * price_cache_create / 1_000_000
-    cost_cache_read = total_cache_read * price_cache_read / 1_000_000
-    cost_total = cost_input + cost_output + cost_cache_create + cost_cache_read
 
-    return {
-        "file_path": str(file_path),
-        "project_dir": project_dir,
-        "model": model,
-        "start_time": start_time,
-        "end_time": end_time,
-        "duration": duration,
-        "total_input": total_input,
-        "total_output": total_output,
-        "total_cache_creation": total_cache_creation,
-        "total_cache_read": total_cache_read,
-        "effective_input": effective_input,
-        "cache_hit_rate": cache_hit_rate,
-        "turn_count": turn_count,
-        "avg_effective_per_turn": avg_effective_per_turn,
-        "avg_output_per_turn": avg_output_per_turn,
-        "total_tool_uses": total_tool_uses,
-        "tool_to_turn": tool_to_turn,
-        "first_effective": first_effective,
-        "mid_effective": mid_effective,
-        "last_effective": last_effective,
-        "peak_effective": peak_effective,
-        "peak_turn": peak_turn,
-        "context_growth": context_growth,
-        "compaction_events": compaction_events,
-        "per_turn_effective": per_turn_effective,
-        "cost_input": cost_input,
-        "cost_output": cost_output,
-        "cost_cache_create": cost_cache_create,
-        "cost_cache_read": cost_cache_read,
-        "cost_total": cost_total,
-        "total_messages": len(messages),
-        "user_messages": len(real_user_msgs),
-        "tool_result_messages": len(tool_result_msgs),
-        "assistant_messages": len(assistant_msgs),
-    }
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+
+def sparkline(values, width=60):
+    """Render values as a one-line block sparkline, keeping each column's peak."""
+    n = len(values)
+    if not n:
+        return ""
+    if n > width:
+        columns = [max(values[int(c * n / width):int((c + 1) * n / width)]) for c in range(width)]
+    else:
+        columns = list(values)
+    top = max(columns)
+    if top <= 0:
+        return SPARK_CHARS[0] * len(columns)
+    scale = len(SPARK_CHARS) - 1
+    return "".join(SPARK_CHARS[round(v / top * scale)] for v in columns)
 
 
 def format_duration(td):
@@ -288,45 +2761,97 @@ def print_session_report(metrics, index):
     print(f"  End:      {format_timestamp(m['end_time'])}")
     print(f"  Duration: {format_duration(m['duration'])}")
 
-    print(f"\n  --- Token Summary ---")
+    print("\n  --- Token Summary ---")
     print(f"  Effective input:       {m['effective_input']:>12,}  (total context processed)")
     print(f"    Cache read:          {m['total_cache_read']:>12,}  ({m['cache_hit_rate']:.0f}% — cheapest)")
     print(f"    Cache creation:      {m['total_cache_creation']:>12,}  (1.25x input price)")
     print(f"    Uncached input:      {m['total_input']:>12,}  (full input price)")
     print(f"  Output tokens:         {m['total_output']:>12,}")
 
-    print(f"\n  --- Estimated Cost ---")
+    print("\n  --- Estimated Cost ---")
     print(f"  Cache read:            ${m['cost_cache_read']:>11.2f}")
     print(f"  Cache creation:        ${m['cost_cache_create']:>11.2f}")
     print(f"  Uncached input:        ${m['cost_input']:>11.2f}")
     print(f"  Output:                ${m['cost_output']:>11.2f}")
     print(f"  TOTAL:                 ${m['cost_total']:>11.2f}")
 
-    print(f"\n  --- Turn Analysis ---")
+    print("\n  --- Turn Analysis ---")
     print(f"  Total messages:        {m['total_messages']:>12,}")
     print(f"  User messages:         {m['user_messages']:>12,}")
     print(f"  Tool result messages:  {m['tool_result_messages']:>12,}")
     print(f"  Assistant turns:       {m['assistant_messages']:>12,}")
     print(f"  Avg context/turn:      {m['avg_effective_per_turn']:>12,.0f}")
     print(f"  Avg output/turn:       {m['avg_output_per_turn']:>12,.0f}")
+    if m["duplicate_messages"]:
+        print(f"  Duplicates skipped:    {m['duplicate_messages']:>12,}  (already counted in an earlier session)")
 
-    print(f"\n  --- Tool Usage ---")
+    print("\n  --- Tool Usage ---")
     print(f"  Total tool calls:      {m['total_tool_uses']:>12,}")
     print(f"  Tool-to-turn ratio:    {m['tool_to_turn']:>12.1f}")
+    if m["unmatched_tool_results"]:
+        print(f"  Unmatched results:     {m['unmatched_tool_results']:>12,}  "
+              "(tool_use made in another session; not attributed)")
+    if m["tool_attribution"]:
+        print("\n  --- Tool Context Attribution (estimated) ---")
+        print(f"  {'Tool':<16} {'Calls':>6} {'Result tok':>11} {'Context tok':>12} {'Cost':>9}")
+        for name, t in m["tool_attribution"].items():
+            print(f"  {name[:16]:<16} {t['calls']:>6,} {format_tokens(t['result_tokens']):>11} "
+                  f"{format_tokens(t['context_tokens']):>12} ${t['cost']:>8.2f}")
+        print("  Largest calls:")
+        for c in m["top_tool_calls"]:
+            print(f"    Turn {c['turn']:>3}: {c['tool'][:16]:<16} {format_tokens(c['result_tokens']):>7} tok  "
+                  f"carried {c['turns_carried']:>3} turns  ${c['cost']:>6.2f}  {c['tool_use_id'] or ''}")
+
+    if m["subagents"]:
+        main_turns = m["turn_count"]
+        sub_turns = m["subagent_turns"]
+        share = m["delegated_cost"] / m["cost_total"] * 100 if m["cost_total"] else 0.0
+        print("\n  --- Sub-agents ---")
+        print(f"  Main thread:           ${m['main_cost']:>11.2f}  ({main_turns:,} turns, "
+              f"${m['main_cost'] / main_turns if main_turns else 0:.3f}/turn)")
+        print(f"  Delegated:             ${m['delegated_cost']:>11.2f}  ({share:.0f}%, {sub_turns:,} turns in "
+              f"{len(m['subagents'])} sub-agent(s), ${m['delegated_cost'] / sub_turns if sub_turns else 0:.3f}/turn)")
+        print(f"  {'Agent':<22} {'Model':<18} {'From':>5} {'Turns':>6} {'Peak':>7} {'Eff. input':>10} {'Cost':>8}")
+        for b in m["subagents"][:10]:
+            print(f"  {b['agent'][:22]:<22} {b['model'][:18]:<18} {b['spawned_at_turn']:>5} {b['turns']:>6,} "
+                  f"{format_tokens(b['peak_effective']):>7} {format_tokens(b['effective_input']):>10} "
+                  f"${b['cost']:>7.2f}")
+        if len(m["subagents"]) > 10:
+            print(f"  … and {len(m['subagents']) - 10} more")
 
-    print(f"\n  --- Context Growth ---")
+    print("\n  --- Context Growth ---")
     print(f"  First turn context:    {m['first_effective']:>12,}")
     print(f"  Mid turn context:      {m['mid_effective']:>12,}")
     print(f"  Last turn context:     {m['last_effective']:>12,}")
     print(f"  Peak context:          {m['peak_effective']:>12,}  (turn {m['peak_turn']})")
     print(f"  Peak growth factor:    {m['context_growth']:>12.1f}x")
+    if m["per_turn_effective"]:
+        print(f"  Context curve:         {sparkline(m['per_turn_effective'])}")
 
     if m["compaction_events"]:
-        print(f"\n  --- Compaction Events ---")
+        print("\n  --- Compaction Events ---")
         for evt in m["compaction_events"]:
             print(f"  Turn {evt['turn']:>3}: {evt['before']:>10,} → {evt['after']:>10,}  "
                   f"(-{evt['reduction_pct']:.0f}%)")
 
+    histogram = m["idle_gap_histogram"]
+    if m["cache_rebuilds"] or any(b["turns"] for b in histogram.values()):
+        print("\n  --- Cache Rebuilds ---")
+        print(f"  Rebuilds:              {m['cache_rebuild_count']:>12,}  (${m['cache_rebuild_cost']:.2f} over cache reads)")
+        for cause, cost in sorted(m["cache_rebuild_cost_by_cause"].items(), key=lambda x: x[1], reverse=True):
+            count = sum(1 for r in m["cache_rebuilds"] if r["cause"] == cause)
+            print(f"    {cause + ':':<20} {count:>12,}  ${cost:.2f}")
+        for r in sorted(m["cache_rebuilds"], key=lambda r: r["cost"], reverse=True)[:5]:
+            gap = format_duration(timedelta(seconds=r["gap_seconds"])) if r["gap_seconds"] is not None else "?"
+            print(f"  Turn {r['turn']:>3}: {r['tokens']:>10,} tok after {gap:>8} idle  "
+                  f"{r['cause']:<13}  ${r['cost']:.2f}")
+        widest = max(b["turns"] for b in histogram.values()) or 1
+        print("  Idle gaps between turns:")
+        for label, b in histogram.items():
+            bar = "#" * math.ceil(b["turns"] / widest * 30) if b["turns"] else ""
+            rebuild = f"  ${b['rebuild_cost']:.2f} rebuilds" if b["rebuild_cost"] else ""
+            print(f"    {label:>6} {b['turns']:>6,}  {bar}{rebuild}".rstrip())
+
 
 def print_comparison_table(all_metrics):
     """Print a cross-session comparison table."""
@@ -348,7 +2873,7 @@ def print_comparison_table(all_metrics):
     col_w = 12
 
     # Header
-    header = f"  {'Session':<{label_w}} {'Duration':>{col_w}} {'Eff.Input':>{col_w}} {'Output':>{col_w}} {'Cache%':>{col_w}} {'Turns':>{col_w}} {'Ctx/Turn':>{col_w}} {'Peak Ctx':>{col_w}} {'Growth':>{col_w}} {'Est.Cost':>{col_w}}"
+    header = f"  {'Session':<{label_w}} {'Duration':>{col_w}} {'Eff.Input':>{col_w}} {'Output':>{col_w}} {'Cache%':>{col_w}} {'Turns':>{col_w}} {'Ctx/Turn':>{col_w}} {'Peak Ctx':>{col_w}} {'Growth':>{col_w}} {'Rebuild$':>{col_w}} {'Est.Cost':>{col_w}}"
     print(header)
     print(f"  {'-' * (len(header) - 2)}")
 
@@ -358,13 +2883,15 @@ def print_comparison_table(all_metrics):
         eff_inp = format_tokens(m["effective_input"])
         out = format_tokens(m["total_output"])
         cache = f"{m['cache_hit_rate']:.0f}%"
-        turns = str(m["turn_count"])
-        ctx_turn = format_tokens(int(m["avg_effective_per_turn"]))
+        # Turns and context per turn on the same basis as Eff.Input: main thread plus sub-agents
+        turns = str(m["assistant_messages"])
+        ctx_turn = format_tokens(m["effective_input"] // m["assistant_messages"] if m["assistant_messages"] else 0)
         peak = format_tokens(m["peak_effective"])
         growth = f"{m['context_growth']:.1f}x"
+        rebuild = f"${m['cache_rebuild_cost']:.2f}"
         cost = f"${m['cost_total']:.2f}"
 
-        print(f"  {label:<{label_w}} {dur:>{col_w}} {eff_inp:>{col_w}} {out:>{col_w}} {cache:>{col_w}} {turns:>{col_w}} {ctx_turn:>{col_w}} {peak:>{col_w}} {growth:>{col_w}} {cost:>{col_w}}")
+        print(f"  {label:<{label_w}} {dur:>{col_w}} {eff_inp:>{col_w}} {out:>{col_w}} {cache:>{col_w}} {turns:>{col_w}} {ctx_turn:>{col_w}} {peak:>{col_w}} {growth:>{col_w}} {rebuild:>{col_w}} {cost:>{col_w}}")
 
 
 def print_recommendations(all_metrics):
@@ -407,6 +2934,19 @@ def print_recommendations(all_metrics):
                 f"    - Check if large files are being re-read unnecessarily"
             )
 
+        # Cache entries expiring while the session sat idle
+        idle_cost = m["cache_rebuild_cost_by_cause"].get("idle expiry", 0.0)
+        if idle_cost > 1:
+            idle_turns = [r["turn"] for r in m["cache_rebuilds"] if r["cause"] == "idle expiry"]
+            recommendations.append(
+                f"  [{session_label}] CACHE EXPIRED WHILE IDLE (${idle_cost:.2f})\n"
+                f"    The prompt cache was rebuilt after an idle gap of over "
+                f"{CACHE_TTL_SECONDS // 60} minutes at turn(s) {', '.join(map(str, idle_turns))}.\n"
+                f"    Consider:\n"
+                f"    - Use /compact (or start a new session) before stepping away\n"
+                f"    - Resume long-idle work in a fresh, smaller session"
+            )
+
         # High context growth (using peak, which accounts for compaction)
         if m["context_growth"] > 5:
             compact_note = ""
@@ -426,11 +2966,12 @@ def print_recommendations(all_metrics):
                 f"    - Avoid reading very large files repeatedly"
             )
 
-        # High turn count
+        # High turn count (turn_count and the context average cover the main thread only)
         if m["turn_count"] > 60:
-            cost_per_turn = m["cost_total"] / m["turn_count"] if m["turn_count"] > 0 else 0
+            cost_per_turn = m["main_cost"] / m["turn_count"] if m["turn_count"] > 0 else 0
+            delegated = f", plus {m['subagent_turns']} in sub-agents" if m["subagent_turns"] else ""
             recommendations.append(
-                f"  [{session_label}] HIGH TURN COUNT ({m['turn_count']} turns)\n"
+                f"  [{session_label}] HIGH TURN COUNT ({m['turn_count']} turns{delegated})\n"
                 f"    Each turn re-sends the full context. At avg "
                 f"{format_tokens(int(m['avg_effective_per_turn']))} tokens/turn, "
                 f"that's ~${cost_per_turn:.2f}/turn.\n"
@@ -507,6 +3048,644 @@ def print_recommendations(all_metrics):
         print()
 
 
+def print_simulation_report(simulator):
+    """Print simulated cost and peak context for each compaction policy."""
+    results = simulator.results()
+    print(f"\n{'=' * 78}")
+    print(f"  COMPACTION SIMULATION ({simulator.sessions} sessions, "
+          f"post-compaction context {format_tokens(simulator.post_size)})")
+    print(f"{'=' * 78}\n")
+    print(f"  {'Policy':<18} {'Compactions':>11} {'Peak (max)':>11} {'Peak (avg)':>11} "
+          f"{'Sim. cost':>11} {'Savings':>16}")
+    for r in results:
+        if r["kind"] == "recorded" or r["savings"] is None:
+            savings = "-"
+        else:
+            sign = "-" if r["savings"] < 0 else ""
+            savings = f"{sign}${abs(r['savings']):,.2f} ({r['savings_pct']:.0f}%)"
+        print(f"  {r['policy']:<18} {r['compactions']:>11,} {format_tokens(r['peak_max']):>11} "
+              f"{format_tokens(int(r['peak_mean'])):>11} ${r['cost']:>10,.2f} {savings:>16}")
+
+    best = min(results, key=lambda r: r["cost"])
+    print()
+    if best["kind"] == "recorded":
+        print("  No simulated policy beats the sessions as recorded.")
+    else:
+        print(f"  Cheapest policy: compact {best['policy']} — saves ${best['savings']:,.2f} "
+              f"({best['savings_pct']:.0f}%) across {simulator.sessions} sessions.")
+    print("  Simulated costs model cache pricing only; compare policies against each other,")
+    print("  not against the estimated costs in the session reports.")
+    print()
+
+
+def print_chain_report(chains, gap):
+    """Print per-chain totals, each chain's phase breakdown, and cost by phase across chains."""
+    print(f"\n{'=' * 78}")
+    print(f"  WORKFLOW CHAINS ({len(chains)} chains, gap <= {format_duration(gap)})")
+    print(f"{'=' * 78}")
+
+    col_w = 10
+    header = (f"  {'Session':<10} {'Phase':<24} {'Duration':>{col_w}} {'Turns':>{col_w}} "
+              f"{'Eff.Input':>{col_w}} {'Peak Ctx':>{col_w}} {'Est.Cost':>{col_w}} {'Share':>7}")
+    by_phase = {}
+    summaries = []
+    for i, chain in enumerate(chains):
+        summary = summarise_chain(chain)
+        summaries.append(summary)
+        start = summary["start_time"].strftime("%Y-%m-%d %H:%M") if summary["start_time"] else "N/A"
+        print(f"\n  --- Chain {i + 1}: {summary['project_dir']} ({start}, {', '.join(summary['models'])}) ---")
+        print(header)
+        print(f"  {'-' * (len(header) - 2)}")
+        for position, m in enumerate(chain, 1):
+            phase = phase_label(m, position)
+            share = m["cost_total"] / summary["cost_total"] * 100 if summary["cost_total"] else 0.0
+            print(f"  {session_id(m['file_path'])[:8]:<10} {phase[:24]:<24} "
+                  f"{format_duration(m['duration']):>{col_w}} {m['assistant_messages']:>{col_w}} "
+                  f"{format_tokens(m['effective_input']):>{col_w}} {format_tokens(m['peak_effective']):>{col_w}} "
+                  f"{'$' + format(m['cost_total'], '.2f'):>{col_w}} {share:>6.0f}%")
+            stats = by_phase.setdefault(phase, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += m["assistant_messages"]
+            stats[2] += m["cost_total"]
+        print(f"  {'':<10} {'Total':<24} {format_duration(summary['duration']):>{col_w}} "
+              f"{summary['assistant_messages']:>{col_w}} {format_tokens(summary['effective_input']):>{col_w}} "
+              f"{format_tokens(summary['peak_effective']):>{col_w}} "
+              f"{'$' + format(summary['cost_total'], '.2f'):>{col_w}}")
+
+    total_cost = sum(s["cost_total"] for s in summaries)
+    print("\n  --- Cost by Phase (all chains) ---")
+    print(f"  {'Phase':<24} {'Sessions':>{col_w}} {'Avg Turns':>{col_w}} {'Avg Cost':>{col_w}} "
+          f"{'Total':>{col_w}} {'Share':>7}")
+    for phase, (count, turns, cost) in sorted(by_phase.items(), key=lambda x: x[1][2], reverse=True):
+        share = cost / total_cost * 100 if total_cost else 0.0
+        print(f"  {phase[:24]:<24} {count:>{col_w}} {turns / count:>{col_w}.0f} "
+              f"{'$' + format(cost / count, '.2f'):>{col_w}} {'$' + format(cost, '.2f'):>{col_w}} "
+              f"{share:>6.0f}%")
+    print()
+
+
+def print_fleet_report(summary):
+    """Print fleet-wide totals, percentiles and the most expensive sessions and projects."""
+    totals = summary.totals
+    print(f"\n{'=' * 78}")
+    print(f"  FLEET SUMMARY ({summary.sessions:,} sessions)")
+    print(f"{'=' * 78}\n")
+    denominator = totals["total_cache_read"] + totals["total_cache_creation"] + totals["total_input"]
+    cache_rate = totals["total_cache_read"] / denominator * 100 if denominator else 0.0
+    print(f"  Estimated cost:        ${totals['cost_total']:>11,.2f}")
+    print(f"  Effective input:       {format_tokens(totals['effective_input']):>12}")
+    print(f"  Output tokens:         {format_tokens(totals['total_output']):>12}")
+    print(f"  Assistant turns:       {totals['assistant_messages']:>12,}")
+    print(f"  Fleet cache hit rate:  {cache_rate:>11.0f}%")
+    print(f"  Sessions compacted:    {summary.sessions_with_compaction:>12,}")
+    if totals["duplicate_messages"]:
+        print(f"  Duplicates skipped:    {totals['duplicate_messages']:>12,}")
+    if totals["subagent_turns"]:
+        share = totals["delegated_cost"] / totals["cost_total"] * 100 if totals["cost_total"] else 0.0
+        print(f"  Delegated cost:        ${totals['delegated_cost']:>11,.2f}  "
+              f"({share:.0f}%, {totals['subagent_turns']:,} sub-agent turns)")
+
+    col_w = 11
+    print("\n  --- Per-Session Distribution ---")
+    print(f"  {'Metric':<14} {'Mean':>{col_w}} {'p50':>{col_w}} {'p90':>{col_w}} {'p99':>{col_w}} {'Max':>{col_w}}")
+    for key, label in FLEET_QUANTILE_METRICS:
+        sketch = summary.sketches[key]
+        values = (sketch.mean, sketch.quantile(0.5), sketch.quantile(0.9), sketch.quantile(0.99),
+                  sketch.max if sketch.count else 0)
+        if key == "cost_total":
+            cells = [f"${v:,.2f}" for v in values]
+        elif key == "cache_hit_rate":
+            cells = [f"{v:.0f}%" for v in values]
+        else:
+            cells = [format_tokens(int(v)) for v in values]
+        print(f"  {label:<14} " + " ".join(f"{c:>{col_w}}" for c in cells))
+
+    print("\n  --- Most Expensive Sessions ---")
+    for cost, item in summary.top_sessions.items():
+        start = item["start_time"][:10] if item["start_time"] else "??"
+        print(f"  ${cost:>9,.2f}  {item['assistant_messages']:>5} turns  peak {format_tokens(item['peak_effective']):>7}  "
+              f"{start}  {item['project_dir']}/{session_id(item['file_path'])[:8]}")
+
+    print("\n  --- Most Expensive Projects ---")
+    for name, (count, turns, cost) in summary.top_projects():
+        print(f"  ${cost:>9,.2f}  {count:>5} sessions  {turns:>7,} turns  {name}")
+
+    print("\n  --- By Model ---")
+    for name, (count, turns, cost) in sorted(summary.models.items(), key=lambda x: x[1][2], reverse=True):
+        print(f"  ${cost:>9,.2f}  {count:>5} sessions  {turns:>7,} turns  {name}")
+    print()
+
+
+def print_rollup_report(rows, period, by=None, updated=(0, 0)):
+    """Print a per-period cost table (optionally split by project or model) with a cost trend."""
+    heading, _ = ROLLUP_PERIODS[period]
+    print(f"\n{'=' * 78}")
+    print(f"  {heading} ROLLUP" + (f" BY {by.upper()}" if by else ""))
+    print(f"{'=' * 78}\n")
+    files, buckets = updated
+    print(f"  Updated from {files:,} new or changed file(s); {buckets:,} hourly bucket(s) touched.\n")
+    group_w = 26 if by else 0
+    header = f"  {period.capitalize():<16}"
+    if by:
+        header += f" {by.capitalize():<{group_w}}"
+    print(header + f" {'Turns':>7} {'Eff. input':>10} {'Output':>8} {'Cache':>6} {'Cost':>10}")
+    totals = dict.fromkeys(("turns", "effective_input", "cache_read", "output", "cost"), 0)
+    for row in rows:
+        line = f"  {row['period']:<16}"
+        if by:
+            name = row[by]
+            line += f" {name if len(name) <= group_w else '…' + name[-(group_w - 1):]:<{group_w}}"
+        print(line + f" {row['turns']:>7,} {format_tokens(row['effective_input']):>10} "
+                     f"{format_tokens(row['output']):>8} {row['cache_hit_rate']:>5.0f}% {'$' + format(row['cost'], ',.2f'):>10}")
+        for key in totals:
+            totals[key] += row[key]
+    cache_rate = totals["cache_read"] / totals["effective_input"] * 100 if totals["effective_input"] else 0.0
+    print(f"  {'Total':<16}" + (f" {'':<{group_w}}" if by else "")
+          + f" {totals['turns']:>7,} {format_tokens(totals['effective_input']):>10} "
+            f"{format_tokens(totals['output']):>8} {cache_rate:>5.0f}% {'$' + format(totals['cost'], ',.2f'):>10}")
+
+    periods = {}
+    for row in rows:
+        periods[row["period"]] = periods.get(row["period"], 0.0) + row["cost"]
+    if len(periods) > 1:
+        print(f"\n  Cost trend ({len(periods)} {period}s): {sparkline(list(periods.values()))}")
+    print()
+
+
+def write_rollup(rows, fmt, period, by=None, stream=None):
+    """Write rollup rows as ndjson, csv or a single json document."""
+    stream = stream or sys.stdout
+    if fmt == "ndjson":
+        for row in rows:
+            stream.write(json.dumps(row) + "\n")
+    elif fmt == "csv":
+        columns = ["period"] + ([by] if by else []) + [
+            "turns", "effective_input", "cache_read", "output", "cache_hit_rate", "cost"]
+        writer = csv.DictWriter(stream, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        stream.write(json.dumps({"period": period, "by": by, "rows": rows}, indent=2) + "\n")
+
+
+def print_period_comparison(rows, labels, counts, iterations, confidence=0.95):
+    """Print mean and median per-session changes between two session sets with bootstrap CIs."""
+    level = f"{confidence * 100:.0f}%"
+    print(f"\n{'=' * 78}")
+    print(f"  PERIOD COMPARISON ({iterations:,} bootstrap resamples, {level} CI)")
+    print(f"{'=' * 78}\n")
+    print(f"  Baseline:   {labels[0]}  ({counts[0]:,} sessions)")
+    print(f"  Candidate:  {labels[1]}  ({counts[1]:,} sessions)")
+
+    def cell(key, value):
+        if key in ("cost_total", "cache_rebuild_cost"):
+            return f"${value:,.2f}"
+        if key == "cache_hit_rate":
+            return f"{value:.0f}%"
+        if key == "assistant_messages":
+            return f"{value:,.1f}"
+        return format_tokens(int(value))
+
+    for stat in ("mean", "median"):
+        print(f"\n  --- {stat.capitalize()} per Session ---")
+        print(f"  {'Metric':<14} {'Baseline':>10} {'Candidate':>10} {'Change':>8}   {level} CI")
+        for r in rows:
+            change, ci = r[f"{stat}_change_pct"], r[f"{stat}_ci"]
+            change_cell = f"{change:+.1f}%" if change is not None else "n/a"
+            ci_cell = f"[{ci[0]:+.1f}%, {ci[1]:+.1f}%]" if ci else "n/a"
+            mark = "  *" if r[f"{stat}_significant"] else ""
+            line = (f"  {r['label']:<14} {cell(r['metric'], r[f'baseline_{stat}']):>10} "
+                    f"{cell(r['metric'], r[f'candidate_{stat}']):>10} {change_cell:>8}   {ci_cell:<18}{mark}")
+            print(line.rstrip())
+
+    print(f"\n  * The {level} interval excludes zero: the change is unlikely to be resampling noise.")
+    print("  Intervals resample whole sessions, so they assume sessions are independent.")
+    print()
+
+
+def print_watch_status(watchers):
+    """Print a compact live status table for watched sessions."""
+    print(f"  {datetime.now().strftime('%H:%M:%S')}  watching {len(watchers)} session(s) — Ctrl-C to stop\n")
+    col_w = 10
+    print(f"  {'Session':<32} {'Turns':>{col_w}} {'Context':>{col_w}} {'Peak':>{col_w}} "
+          f"{'Cache%':>{col_w}} {'Cost':>{col_w}}  Compaction")
+    print(f"  {'-' * 98}")
+    for w in watchers:
+        acc = w.acc
+        series = acc.per_turn_effective
+        name = f"{w.file_path.parent.name}/{session_id(w.file_path)}"
+        if len(name) > 32:
+            name = "..." + name[-29:]
+        context = series[-1] if series else 0
+        notes = []
+        if context > COMPACT_THRESHOLD:
+            notes.append(f"OVER {format_tokens(COMPACT_THRESHOLD)} — /compact now")
+        elif acc.peak_effective > COMPACT_THRESHOLD:
+            notes.append(f"crossed {format_tokens(COMPACT_THRESHOLD)} at peak")
+        if acc.compaction_events:
+            notes.append(f"{len(acc.compaction_events)} compaction(s), last at turn "
+                         f"{acc.compaction_events[-1]['turn']}")
+        compaction = "; ".join(notes) or "-"
+        # Turns, context and peak follow the main thread; cache % and cost include sub-agents
+        cache_hit_rate, cost = acc.session_totals()
+        print(f"  {name:<32} {len(series):>{col_w}} {format_tokens(context):>{col_w}} "
+              f"{format_tokens(acc.peak_effective):>{col_w}} {cache_hit_rate:>{col_w - 1}.0f}% "
+              f"{'$' + format(cost, '.2f'):>{col_w}}  {compaction}")
+    print()
+
+
+def watch_sessions(session_files, interval):
+    """Poll session files for appended lines and refresh the status view until interrupted."""
+    watchers = [SessionWatcher(path) for path in session_files]
+    clear = sys.stdout.isatty()
+    changed = True
+    try:
+        while True:
+            for w in watchers:
+                changed = w.poll() or changed
+            if changed:
+                if clear:
+                    print("\033[H\033[J", end="")
+                print_watch_status(watchers)
+                sys.stdout.flush()
+                changed = False
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+# Scalar metrics written for each session by --format ndjson|csv|json
+RECORD_FIELDS = (
+    "file_path", "project_dir", "model", "command", "start_time", "end_time", "duration_seconds",
+    "total_input", "total_output", "total_cache_creation", "total_cache_read", "effective_input",
+    "cache_hit_rate", "turn_count", "avg_effective_per_turn", "avg_output_per_turn",
+    "total_tool_uses", "tool_to_turn", "first_effective", "mid_effective", "last_effective",
+    "peak_effective", "peak_turn", "context_growth", "cache_rebuild_count", "cache_rebuild_cost",
+    "cost_input", "cost_output",
+    "cost_cache_create", "cost_cache_read", "cost_total", "total_messages", "user_messages",
+    "tool_result_messages", "assistant_messages", "duplicate_messages", "unmatched_tool_results",
+    "main_cost", "delegated_cost", "subagent_turns",
+)
+
+
+def metrics_record(m, include_series=False):
+    """Flatten a metrics dict into a JSON-serialisable record."""
+    record = {}
+    for field in RECORD_FIELDS:
+        if field == "duration_seconds":
+            record[field] = m["duration"].total_seconds() if m["duration"] is not None else None
+        elif field in ("start_time", "end_time"):
+            record[field] = m[field].isoformat() if m[field] is not None else None
+        else:
+            record[field] = m[field]
+    record["compaction_events"] = m["compaction_events"]
+    record["tool_attribution"] = m["tool_attribution"]
+    record["top_tool_calls"] = m["top_tool_calls"]
+    record["cache_rebuilds"] = m["cache_rebuilds"]
+    record["subagents"] = m["subagents"]
+    record["idle_gap_histogram"] = {label: b["turns"] for label, b in m["idle_gap_histogram"].items()}
+    if include_series:
+        record["per_turn_effective"] = list(m["per_turn_effective"])
+    return record
+
+
+class NdjsonWriter:
+    """One JSON object per line, flushed as each session is computed."""
+
+    def __init__(self, stream, include_series=False):
+        self.stream = stream
+        self.include_series = include_series
+
+    def write(self, metrics):
+        self.stream.write(json.dumps(metrics_record(metrics, self.include_series)) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class CsvWriter:
+    """One CSV row per session. Compaction turns, per-tool costs (and the
+    per-turn series if requested) are packed into ';'-separated cells."""
+
+    def __init__(self, stream, include_series=False):
+        self.stream = stream
+        self.include_series = include_series
+        columns = list(RECORD_FIELDS) + ["compaction_count", "compaction_turns", "tool_costs"]
+        if include_series:
+            columns.append("per_turn_effective")
+        self.writer = csv.DictWriter(stream, fieldnames=columns)
+        self.writer.writeheader()
+
+    def write(self, metrics):
+        record = metrics_record(metrics)
+        events = record.pop("compaction_events")
+        record["compaction_count"] = len(events)
+        record["compaction_turns"] = ";".join(str(e["turn"]) for e in events)
+        record["tool_costs"] = ";".join(f"{name}={t['cost']:.4f}" for name, t in record.pop("tool_attribution").items())
+        del record["top_tool_calls"], record["cache_rebuilds"], record["idle_gap_histogram"], record["subagents"]
+        if self.include_series:
+            record["per_turn_effective"] = ";".join(map(str, metrics["per_turn_effective"]))
+        self.writer.writerow(record)
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class JsonWriter:
+    """A single JSON document: a streamed `sessions` array followed by a `summary`
+    of running totals, so the fleet is never buffered."""
+
+    def __init__(self, stream, include_series=False):
+        self.stream = stream
+        self.include_series = include_series
+        self.count = 0
+        self.totals = dict.fromkeys(
+            ("effective_input", "total_output", "assistant_messages", "cost_total"), 0
+        )
+        stream.write('{"generated": %s, "sessions": [' % json.dumps(datetime.now().isoformat()))
+
+    def write(self, metrics):
+        if self.count:
+            self.stream.write(",")
+        self.stream.write("\n  " + json.dumps(metrics_record(metrics, self.include_series)))
+        self.stream.flush()
+        self.count += 1
+        for key in self.totals:
+            self.totals[key] += metrics[key]
+
+    def close(self):
+        summary = {"sessions": self.count, **self.totals}
+        self.stream.write('\n], "summary": %s}\n' % json.dumps(summary))
+        self.stream.flush()
+
+
+RECORD_WRITERS = {"ndjson": NdjsonWriter, "csv": CsvWriter, "json": JsonWriter}
+
+
+def write_records(results, fmt, include_series=False, stream=None):
+    """Stream (file_path, metrics) results to stream in a machine-readable format."""
+    writer = RECORD_WRITERS[fmt](stream or sys.stdout, include_series)
+    written = 0
+    for file_path, metrics in results:
+        if metrics is None:
+            print(f"Warning: No messages found in {file_path}, skipping.", file=sys.stderr)
+            continue
+        writer.write(metrics)
+        written += 1
+    writer.close()
+    return written
+
+
+class _IndexedSession:
+    """One session file in a SessionIndex: change signature, message keys and the record served for it."""
+
+    __slots__ = ("signature", "mtime", "keys", "record", "dropped")
+
+    def __init__(self, signature, mtime, metrics):
+        self.signature = signature
+        self.mtime = mtime
+        self.keys = metrics.pop("message_keys") if metrics is not None else None
+        self.record = metrics_record(metrics) if metrics is not None else None
+        self.dropped = frozenset()  # keys left out of the record as copies of older files
+
+
+class SessionIndex:
+    """In-memory index of per-session records for --serve.
+
+    refresh() lists the session tree and re-analyses only files whose size
+    or mtime changed since the last refresh, so with the parse cache an
+    appended session costs only its new lines. Each session is kept as its
+    flattened metrics_record (no per-turn series), and the fleet summary is
+    rebuilt lazily, only after something changed. Readers see a consistent
+    snapshot: refresh() builds new state and swaps it in under the lock.
+
+    Records are de-duplicated like a CLI run over the same tree: after a
+    change, every file's message keys are checked against older files', and
+    only files whose set of copied messages changed are re-analysed.
+    """
+
+    def __init__(self, root, project=None, since=None, until=None, cache_path=None, jobs=1):
+        self.root = root
+        self.filters = (project, since, until)
+        self.cache_path = cache_path
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.files = {}  # path -> _IndexedSession, including files without messages
+        self.entries = {}  # path -> record, for sessions with messages
+        self.refreshed_at = None
+        self.refresh_seconds = 0.0
+        self._fleet = None
+
+    def refresh(self):
+        """Re-scan the tree; returns the number of sessions added, changed or removed."""
+        start = time.perf_counter()
+        project, since, until = self.filters
+        current = self.files
+        files = {}
+        changed = []
+        for mtime, path, st in iter_session_entries(self.root, project, since, until, with_stat=True):
+            key = str(path)
+            known = current.get(key)
+            signature = session_signature(path, st)
+            if known is not None and known.signature == signature:
+                files[key] = known
+            else:
+                changed.append((key, mtime, signature))
+        if changed:
+            paths = [Path(key) for key, _, _ in changed]
+            analysed = analyse_sessions(paths, self.cache_path, self.jobs, collect_keys=True)
+            for (key, mtime, signature), (_, metrics) in zip(changed, analysed):
+                files[key] = _IndexedSession(signature, mtime, metrics)
+        updates = len(changed) + len(current.keys() - files.keys())
+        if updates:
+            self._deduplicate(files)
+        entries = {key: f.record for key, f in files.items() if f.record is not None}
+        with self.lock:
+            self.files = files
+            self.entries = entries
+            if updates:
+                self._fleet = None
+            self.refreshed_at = datetime.now(timezone.utc)
+            self.refresh_seconds = time.perf_counter() - start
+        return updates
+
+    def _deduplicate(self, files):
+        """Re-analyse files whose messages copied from older files changed, oldest first."""
+        seen = set()
+        redo = []
+        for key, f in sorted(files.items(), key=lambda item: (item[1].mtime, item[0])):
+            if f.keys is None:
+                continue
+            duplicates = frozenset(k for k in f.keys if k in seen)
+            seen.update(f.keys)
+            if duplicates != f.dropped:
+                redo.append((key, f, duplicates))
+        if not redo:
+            return
+        cache = open_parse_cache(self.cache_path)
+        try:
+            for key, f, duplicates in redo:
+                metrics = analyse_session(Path(key), cache, seen=set(duplicates))
+                f.record = metrics_record(metrics) if metrics is not None else None
+                f.dropped = duplicates
+        finally:
+            if cache:
+                cache.close()
+
+    def status(self):
+        return {
+            "root": str(self.root),
+            "sessions": len(self.entries),
+            "refreshed_at": self.refreshed_at.isoformat() if self.refreshed_at else None,
+            "refresh_seconds": round(self.refresh_seconds, 4),
+        }
+
+    def recent(self, limit=20, project=None):
+        """Most recently active sessions, newest first, without their nested detail."""
+        records = (r for r in self.entries.values() if project is None or project in r["project_dir"])
+        newest = heapq.nlargest(limit, records, key=lambda r: r["end_time"] or "")
+        return [{field: r[field] for field in RECORD_FIELDS} for r in newest]
+
+    def session(self, ident):
+        """Full record for a session, by file path or session id (file stem)."""
+        record = self.entries.get(ident)
+        if record is None:
+            record = next((r for path, r in self.entries.items() if session_id(path) == ident), None)
+        return record
+
+    def fleet(self, top=10):
+        with self.lock:
+            if self._fleet is None or self._fleet[0] != top:
+                summary = FleetSummary(top)
+                for record in self.entries.values():
+                    summary.add(record)
+                self._fleet = (top, summary.as_dict())
+            return self._fleet[1]
+
+
+class SessionRequestHandler(BaseHTTPRequestHandler):
+    """JSON API over a SessionIndex: /status, /sessions, /session, /fleet."""
+
+    index = None  # set on the subclass serve_sessions() creates
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == "/status":
+                body = self.index.status()
+            elif url.path == "/sessions":
+                body = self.index.recent(self._count(query, "limit", 20), query.get("project"))
+            elif url.path == "/session":
+                body = self.index.session(query.get("id", ""))
+                if body is None:
+                    return self._send(404, {"error": f"no session {query.get('id')!r}"})
+            elif url.path == "/fleet":
+                body = self.index.fleet(self._count(query, "top", 10))
+            else:
+                return self._send(404, {"error": f"unknown endpoint {url.path!r}",
+                                        "endpoints": ["/status", "/sessions", "/session", "/fleet"]})
+        except ValueError as e:
+            return self._send(400, {"error": str(e)})
+        self._send(200, body)
+
+    @staticmethod
+    def _count(query, name, default):
+        """Positive integer query parameter; ValueError (a 400 response) otherwise."""
+        value = query.get(name)
+        if value is None:
+            return default
+        try:
+            count = int(value)
+        except ValueError:
+            count = 0
+        if count < 1:
+            raise ValueError(f"{name} must be a positive integer, got {value!r}")
+        return count
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self):
+        # Unix-socket peers have no (host, port) address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_sessions(index, host="127.0.0.1", port=8765, socket_path=None, interval=2.0):
+    """Index once, then serve the JSON API while refreshing every `interval` seconds."""
+    start = time.perf_counter()
+    index.refresh()
+    handler = type("Handler", (SessionRequestHandler,), {"index": index})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = UnixHTTPServer(socket_path, handler)
+        where = f"unix:{socket_path}"
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+        where = f"http://{host}:{server.server_address[1]}"
+    print(f"  Indexed {len(index.entries)} session(s) in {time.perf_counter() - start:.2f}s; "
+          f"serving on {where} (refresh every {interval:g}s) — Ctrl-C to stop", file=sys.stderr)
+
+    stop = threading.Event()
+
+    def refresher():
+        while not stop.wait(interval):
+            try:
+                index.refresh()
+            except Exception as e:  # keep serving the last good snapshot
+                print(f"  Warning: refresh failed ({e})", file=sys.stderr)
+
+    threading.Thread(target=refresher, daemon=True).start()
+    # Exit through the finally below on SIGTERM too, so the socket file is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        stop.set()
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def print_footer(all_metrics):
+    """Print the totals line across all analysed sessions."""
+    total_all_effective = sum(m["effective_input"] for m in all_metrics)
+    total_all_output = sum(m["total_output"] for m in all_metrics)
+    # Sub-agent turns are in the cost total, so they count as turns here too
+    total_all_turns = sum(m["assistant_messages"] for m in all_metrics)
+    total_all_cost = sum(m["cost_total"] for m in all_metrics)
+    total_duplicates = sum(m["duplicate_messages"] for m in all_metrics)
+    print(f"  {'─' * 74}")
+    print(f"  Total across all sessions: {format_tokens(total_all_effective)} effective input, "
+          f"{format_tokens(total_all_output)} output, {total_all_turns} turns, "
+          f"~${total_all_cost:.2f}")
+    if total_duplicates:
+        print(f"  ({total_duplicates:,} messages copied between sessions counted once)")
+    total_delegated = sum(m["delegated_cost"] for m in all_metrics)
+    if total_delegated:
+        total_sub_turns = sum(m["subagent_turns"] for m in all_metrics)
+        print(f"  (~${total_delegated:.2f} of it and {total_sub_turns:,} of the turns in sub-agents)")
+    print(f"{'#' * 78}\n")
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Analyse Claude Code session logs for token usage efficiency."
@@ -515,7 +3694,7 @@ def main():
         "--sessions", "-n",
         type=int,
         default=5,
-        help="Number of most recent sessions to analyse (default: 5)"
+        help="Number of most recent sessions to analyse; 0 for all (default: 5)"
     )
     parser.add_argument(
         "--file", "-f",
@@ -523,17 +3702,456 @@ def main():
         default=None,
         help="Analyse a specific JSONL session file instead of auto-discovering"
     )
+    parser.add_argument(
+        "--root",
+        type=str,
+        default=None,
+        help="Session tree to discover sessions in (default: ~/.claude/projects); e.g. an --archive directory"
+    )
+    parser.add_argument(
+        "--project", "-p",
+        type=str,
+        default=None,
+        help="Only discover sessions whose project directory name contains this text"
+    )
+    parser.add_argument(
+        "--since",
+        type=parse_date_arg,
+        default=None,
+        help="Only discover sessions modified on or after this date (YYYY-MM-DD or ISO datetime)"
+    )
+    parser.add_argument(
+        "--until",
+        type=lambda v: parse_date_arg(v, end_of_day=True),
+        default=None,
+        help="Only discover sessions modified on or before this date (YYYY-MM-DD or ISO datetime)"
+    )
+    parser.add_argument(
+        "--where",
+        type=parse_where,
+        default=None,
+        metavar="EXPR",
+        help="Only sessions matching e.g. 'model~opus and project~api and turns>60 and since=2026-09-01'; "
+             "--sessions N then counts matching sessions"
+    )
+    parser.add_argument(
+        "--compare",
+        type=parse_where,
+        nargs=2,
+        default=None,
+        metavar=("BASELINE", "CANDIDATE"),
+        help="Compare two session sets given as --where expressions, e.g. 'until=2026-09-30' 'since=2026-10-01', "
+             "with bootstrap confidence intervals"
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=2000,
+        metavar="N",
+        help="Bootstrap resamples for --compare, spread over --jobs processes (default: 2000)"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed for --compare resampling (default: 0)"
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Stream every matching session into fleet-wide totals, percentiles and top sessions/projects"
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        help="How many sessions and projects --all lists (default: 10)"
+    )
+    parser.add_argument(
+        "--chains",
+        action="store_true",
+        help="Group sessions into workflow chains by project and time adjacency and report per-chain totals"
+    )
+    parser.add_argument(
+        "--chain-gap",
+        type=float,
+        default=60,
+        help="Maximum idle minutes between sessions in the same chain (default: 60)"
+    )
+    parser.add_argument(
+        "--simulate",
+        action="store_true",
+        help="Replay the sessions under alternative compaction policies and compare simulated cost"
+    )
+    parser.add_argument(
+        "--sim-thresholds",
+        type=parse_threshold_sweep,
+        default=parse_threshold_sweep("40K:160K:10K"),
+        help="Context thresholds to compact at: START:STOP:STEP or a comma list (default: 40K:160K:10K)"
+    )
+    parser.add_argument(
+        "--sim-every",
+        type=lambda v: sorted({int(n) for n in v.split(",") if n.strip()}),
+        default=[10, 20, 40],
+        help="Comma-separated every-N-turns policies to simulate (default: 10,20,40)"
+    )
+    parser.add_argument(
+        "--sim-post",
+        type=parse_tokens_arg,
+        default=20_000,
+        help="Context size right after a simulated compaction (default: 20K)"
+    )
+    parser.add_argument(
+        "--rollup",
+        choices=tuple(ROLLUP_PERIODS),
+        default=None,
+        help="Update the incremental rollup store and print cost per hour, day, week or month"
+    )
+    parser.add_argument(
+        "--rollup-by",
+        choices=("project", "model"),
+        default=None,
+        help="Split each --rollup period by project or by model"
+    )
+    parser.add_argument(
+        "--rollup-path",
+        type=str,
+        default=str(DEFAULT_ROLLUP_PATH),
+        help=f"SQLite rollup store location (default: {DEFAULT_ROLLUP_PATH})"
+    )
+    parser.add_argument(
+        "--format",
+        choices=("text", *RECORD_WRITERS),
+        default="text",
+        help="Output format: text report, or one streamed record per session as ndjson, csv or json (default: text)"
+    )
+    parser.add_argument(
+        "--series",
+        action="store_true",
+        help="Include the per-turn effective context series in ndjson/csv/json records"
+    )
+    parser.add_argument(
+        "--timeseries",
+        action="store_true",
+        help="With --format ndjson|csv, write per-turn rows (effective context, output, cumulative cost) instead of session records"
+    )
+    parser.add_argument(
+        "--points",
+        type=int,
+        default=0,
+        help="Downsample each --timeseries session to about N points, keeping peaks and compaction drops (default: all turns)"
+    )
+    parser.add_argument(
+        "--watch", "-w",
+        action="store_true",
+        help="Follow the selected sessions as they grow and show a live status view"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=2.0,
+        help="Seconds between --watch polls or --serve index refreshes (default: 2)"
+    )
+    parser.add_argument(
+        "--archive",
+        type=str,
+        default=None,
+        metavar="DIR",
+        help="Write a binary snapshot of each selected session to DIR/<project>/<file name>.ccsnap"
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Run a local daemon that indexes the sessions once and answers JSON queries over HTTP"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="Port for --serve on 127.0.0.1 (default: 8765)"
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=None,
+        help="Serve on this Unix socket path instead of a TCP port"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print per-phase timings, read counters and the slowest files to stderr"
+    )
+    parser.add_argument(
+        "--profile-out",
+        type=str,
+        default=None,
+        help="Dump cProfile stats for the parse stage to this file (pstats format; parent process only with --jobs)"
+    )
+    parser.add_argument(
+        "--cache-path",
+        type=str,
+        default=str(DEFAULT_CACHE_PATH),
+        help=f"SQLite parse cache location (default: {DEFAULT_CACHE_PATH})"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Parse every session from scratch without reading or updating the cache"
+    )
+    parser.add_argument(
+        "--no-dedup",
+        action="store_true",
+        help="Count messages copied into resumed/forked sessions once per file instead of once per run"
+    )
+    parser.add_argument(
+        "--dedup-bloom",
+        type=int,
+        default=0,
+        metavar="MESSAGES",
+        help="De-duplicate with a fixed-size Bloom filter sized for this many messages instead of an exact set"
+    )
+    parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=1,
+        help="Parse sessions in N worker processes; 0 uses every CPU (default: 1)"
+    )
     args = parser.parse_args()
+    if args.format != "text" and (args.chains or args.watch):
+        parser.error("--format ndjson/csv/json can't be combined with --chains or --watch")
+    if args.serve and (args.format != "text" or args.file or args.watch or args.all or args.chains or args.simulate):
+        parser.error("--serve can't be combined with --format, --file, --watch, --all, --chains or --simulate")
+    if args.archive and (args.format != "text" or args.watch or args.all or args.chains or args.simulate or args.serve):
+        parser.error("--archive can't be combined with --format, --watch, --all, --chains, --simulate or --serve")
+    if args.all and (args.format not in ("text", "json") or args.chains or args.watch or args.file):
+        parser.error("--all supports --format text or json and can't be combined with --chains, --watch or --file")
+    if args.simulate and (args.format not in ("text", "json") or args.chains or args.watch or args.all):
+        parser.error("--simulate supports --format text or json and can't be combined with --chains, --watch or --all")
+    if args.timeseries and args.format not in ("ndjson", "csv"):
+        parser.error("--timeseries requires --format ndjson or --format csv")
+    if args.where and (args.watch or args.serve or args.rollup):
+        parser.error("--where can't be combined with --watch, --serve or --rollup")
+    if args.compare and (args.format not in ("text", "json") or args.file or args.watch or args.all or args.chains
+                         or args.simulate or args.serve or args.archive or args.rollup or args.where):
+        parser.error("--compare supports --format text or json and can't be combined with --file, --watch, --all, "
+                     "--chains, --simulate, --serve, --archive, --rollup or --where")
+    if args.top < 1:
+        parser.error("--top must be at least 1")
+    if args.interval <= 0:
+        parser.error("--interval must be positive")
+    if args.chain_gap < 0:
+        parser.error("--chain-gap can't be negative")
+    if not args.sim_thresholds:
+        parser.error("--sim-thresholds selects no thresholds (a START:STOP:STEP sweep needs START <= STOP)")
+    if any(n < 1 for n in args.sim_every):
+        parser.error("--sim-every turn counts must be at least 1")
+    if args.compare and args.bootstrap < 1:
+        parser.error("--bootstrap must be at least 1")
+    if args.rollup_by and not args.rollup:
+        parser.error("--rollup-by requires --rollup")
+    if args.rollup and (args.file or args.watch or args.all or args.chains or args.simulate or args.serve
+                        or args.archive or args.series or args.timeseries):
+        parser.error("--rollup can't be combined with --file, --watch, --all, --chains, --simulate, "
+                     "--serve, --archive, --series or --timeseries")
+
+    profile = RunProfile()
+    cache_path = None if args.no_cache else Path(args.cache_path).expanduser()
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    where = args.where
+    since, until = where.bounds(args.since, args.until) if where else (args.since, args.until)
+
+    def new_seen():
+        if args.no_dedup:
+            return None
+        return BloomFilter(args.dedup_bloom) if args.dedup_bloom > 0 else set()
+
+    seen = new_seen()
+
+    if args.serve:
+        index = SessionIndex(projects_dir(args.root), args.project, args.since, args.until, cache_path, jobs)
+        serve_sessions(index, port=args.port, socket_path=args.socket, interval=args.interval)
+        return
+
+    if args.rollup:
+        try:
+            store = RollupStore(Path(args.rollup_path).expanduser())
+        except (sqlite3.Error, OSError) as e:
+            print(f"Error: rollup store unavailable ({e}).", file=sys.stderr)
+            sys.exit(1)
+        # Every session is stat'ed, but only new or changed ones are analysed;
+        # --since/--until bound the turns reported, not the files checked
+        entries = iter_session_entries(projects_dir(args.root), args.project, with_stat=True)
+        with profile.phase("update rollups"), cprofile_to(args.profile_out):
+            updated = store.update(entries, open_parse_cache(cache_path), dedup=not args.no_dedup)
+        with profile.phase("query + render"):
+            rows = store.query(args.rollup, args.rollup_by, args.project, args.since, args.until)
+            if not rows:
+                print("Error: No valid session data found.", file=sys.stderr)
+                sys.exit(1)
+            if args.format == "text":
+                print_rollup_report(rows, args.rollup, args.rollup_by, updated)
+            else:
+                write_rollup(rows, args.format, args.rollup, args.rollup_by)
+        store.close()
+        if args.profile:
+            profile.print_summary()
+        return
+
+    if args.compare:
+        sets = []
+        for name, expr in zip(("baseline", "candidate"), args.compare):
+            # Each set is its own run: its own discovery bounds and de-duplication
+            set_since, set_until = expr.bounds(args.since, args.until)
+            with profile.phase(f"analyse {name}"), cprofile_to(args.profile_out):
+                files = find_session_files(None, args.project, set_since, set_until, args.root, expr)
+                set_seen = new_seen()
+                order = files[::-1] if set_seen is not None else files
+                sets.append(compare_samples(analyse_sessions(order, cache_path, jobs, seen=set_seen, where=expr)))
+        (baseline, base_count), (candidate, cand_count) = sets
+        if base_count < 2 or cand_count < 2:
+            print(f"Error: --compare needs at least 2 sessions in each set "
+                  f"(baseline {base_count}, candidate {cand_count}).", file=sys.stderr)
+            sys.exit(1)
+        with profile.phase("bootstrap"):
+            rows = bootstrap_compare(baseline, candidate, args.bootstrap, jobs, args.seed)
+        labels = [expr.text for expr in args.compare]
+        with profile.phase("render"):
+            if args.format == "json":
+                print(json.dumps({
+                    "baseline": {"where": labels[0], "sessions": base_count},
+                    "candidate": {"where": labels[1], "sessions": cand_count},
+                    "bootstrap": args.bootstrap, "confidence": 0.95, "seed": args.seed, "metrics": rows,
+                }, indent=2))
+            else:
+                print_period_comparison(rows, labels, (base_count, cand_count), args.bootstrap)
+        if args.profile:
+            profile.print_summary()
+        return
+
+    if args.all:
+        entries = iter_session_entries(projects_dir(args.root), args.project, since, until, where=where)
+        if args.no_dedup:
+            # Unsorted discovery straight into the summary: no path list, no per-session results kept
+            paths = (path for _, path in entries)
+        else:
+            # Oldest first, so copied messages count in the session they came from: one
+            # (mtime, file name) pair per file, merged across directories as it is consumed.
+            # Keys go to a fixed-size Bloom filter, not a set
+            paths = iter_oldest_first(entries)
+            seen = BloomFilter(args.dedup_bloom if args.dedup_bloom > 0 else FLEET_DEDUP_MESSAGES)
+        with profile.phase("discover + analyse"), cprofile_to(args.profile_out):
+            summary = summarise_fleet(paths, cache_path, jobs, args.top, seen=seen, where=where,
+                                      profile=profile if args.profile else None)
+        if not summary.sessions:
+            print("Error: No valid session data found.", file=sys.stderr)
+            sys.exit(1)
+        with profile.phase("render"):
+            if args.format == "json":
+                print(json.dumps(summary.as_dict(), indent=2))
+            else:
+                print_fleet_report(summary)
+        if args.profile:
+            profile.print_summary()
+        return
 
     # Find session files
-    if args.file:
-        file_path = Path(args.file).expanduser().resolve()
-        if not file_path.exists():
-            print(f"Error: File not found: {file_path}", file=sys.stderr)
+    results = None
+    with profile.phase("discovery"):
+        if args.file:
+            file_path = Path(args.file).expanduser().resolve()
+            if not file_path.exists():
+                print(f"Error: File not found: {file_path}", file=sys.stderr)
+                sys.exit(1)
+            session_files = [file_path]
+        elif where is not None and args.sessions > 0:
+            # Which sessions match depends on the de-duplicated metrics, so
+            # selection and analysis are one pass over the candidates
+            candidates = find_session_files(None, args.project, since, until, args.root, where)
+            if seen is None:
+                # Newest first, stopping at the N-th match
+                analysed = analyse_sessions(iter(candidates), cache_path, jobs, args.profile, where=where,
+                                            collect_keys=bool(args.archive))
+                matched = list(itertools.islice(
+                    ((file_path, metrics) for file_path, metrics in profile.track(analysed) if metrics is not None),
+                    args.sessions,
+                ))
+                session_files = [file_path for file_path, _ in matched]
+            else:
+                # Oldest first, as without --where, keeping the newest N matches
+                analysed = analyse_sessions(candidates[::-1], cache_path, jobs, args.profile, seen, where,
+                                            collect_keys=bool(args.archive))
+                matched = deque(
+                    ((file_path, metrics) for file_path, metrics in profile.track(analysed) if metrics is not None),
+                    maxlen=args.sessions,
+                )
+                session_files = [file_path for file_path, _ in reversed(matched)]
+            results = iter(matched)
+        else:
+            session_files = find_session_files(
+                args.sessions if args.sessions > 0 else None, args.project, since, until, args.root, where
+            )
+
+    if args.watch:
+        watch_sessions(session_files, args.interval)
+        return
+
+    # Discovery lists newest first; with de-duplication, analyse oldest first so
+    # messages copied into a resumed session stay attributed to the original
+    oldest_first = seen is not None and len(session_files) > 1
+    if results is None:
+        analysis_order = session_files[::-1] if oldest_first else session_files
+        # Snapshots keep the keys of the messages they count, for de-duplication when loaded
+        results = profile.track(analyse_sessions(analysis_order, cache_path, jobs, args.profile, seen, where,
+                                                 collect_keys=bool(args.archive)))
+        if where is not None:
+            # Sessions filtered out come back as None; they aren't worth a warning
+            results = ((file_path, metrics) for file_path, metrics in results if metrics is not None)
+
+    if args.archive:
+        with profile.phase("analyse + archive"), cprofile_to(args.profile_out):
+            count, source_bytes, snapshot_bytes = archive_sessions(results, args.archive)
+        if args.profile:
+            profile.print_summary()
+        if not count:
+            print("Error: No valid session data found.", file=sys.stderr)
             sys.exit(1)
-        session_files = [file_path]
-    else:
-        session_files = find_session_files(args.sessions)
+        print(f"  Archived {count} session(s) to {Path(args.archive).expanduser()}: "
+              f"{source_bytes / 1e6:,.1f} MB of logs → {snapshot_bytes / 1e6:,.2f} MB of snapshots")
+        return
+
+    if args.simulate:
+        simulator = CompactionSimulator(compaction_policies(args.sim_thresholds, args.sim_every), args.sim_post)
+        with profile.phase("analyse + simulate"), cprofile_to(args.profile_out):
+            for _, metrics in results:
+                if metrics is not None:
+                    simulator.add(metrics)
+        if not simulator.sessions:
+            print("Error: No valid session data found.", file=sys.stderr)
+            sys.exit(1)
+        with profile.phase("render"):
+            if args.format == "json":
+                print(json.dumps({"post_size": simulator.post_size, "policies": simulator.results()}, indent=2))
+            else:
+                print_simulation_report(simulator)
+        if args.profile:
+            profile.print_summary()
+        return
+
+    if args.format != "text":
+        with profile.phase("analyse + write"), cprofile_to(args.profile_out):
+            if oldest_first:
+                # Written newest first, in discovery order, as the text report and --no-dedup are
+                results = reversed(list(results))
+            if args.timeseries:
+                written = write_timeseries(results, args.format, args.points)
+            else:
+                written = write_records(results, args.format, args.series)
+        if args.profile:
+            profile.print_summary()
+        if not written:
+            print("Error: No valid session data found.", file=sys.stderr)
+            sys.exit(1)
+        return
 
     print(f"\n{'#' * 78}")
     print(f"#{'CLAUDE CODE SESSION TOKEN ANALYSIS':^76}#")
@@ -543,40 +4161,40 @@ def main():
 
     # Parse and compute metrics for each session
     all_metrics = []
-    for file_path in session_files:
-        messages = parse_session(file_path)
-        if not messages:
-            print(f"\n  Warning: No messages found in {file_path}, skipping.")
-            continue
-        metrics = compute_session_metrics(file_path, messages)
-        all_metrics.append(metrics)
+    with profile.phase("analyse"), cprofile_to(args.profile_out):
+        for file_path, metrics in results:
+            if metrics is None:
+                print(f"\n  Warning: No messages found in {file_path}, skipping.")
+                continue
+            all_metrics.append(metrics)
+    if oldest_first:
+        all_metrics.reverse()
 
     if not all_metrics:
         print("\n  Error: No valid session data found.")
         sys.exit(1)
 
-    # Print per-session reports
-    for i, metrics in enumerate(all_metrics):
-        print_session_report(metrics, i)
+    with profile.phase("render"):
+        if args.chains:
+            gap = timedelta(minutes=args.chain_gap)
+            print_chain_report(group_chains(all_metrics, gap), gap)
+        else:
+            # Print per-session reports
+            for i, metrics in enumerate(all_metrics):
+                print_session_report(metrics, i)
 
-    # Print cross-session comparison
-    if len(all_metrics) > 1:
-        print_comparison_table(all_metrics)
+            # Print cross-session comparison
+            if len(all_metrics) > 1:
+                print_comparison_table(all_metrics)
 
-    # Print recommendations
-    print_recommendations(all_metrics)
+            # Print recommendations
+            print_recommendations(all_metrics)
 
-    # Summary footer
-    total_all_effective = sum(m["effective_input"] for m in all_metrics)
-    total_all_output = sum(m["total_output"] for m in all_metrics)
-    total_all_turns = sum(m["turn_count"] for m in all_metrics)
-    total_all_cost = sum(m["cost_total"] for m in all_metrics)
-    print(f"  {'─' * 74}")
-    print(f"  Total across all sessions: {format_tokens(total_all_effective)} effective input, "
-          f"{format_tokens(total_all_output)} output, {total_all_turns} turns, "
-          f"~${total_all_cost:.2f}")
-    print(f"{'#' * 78}\n")
+        print_footer(all_metrics)
 
+    if args.profile:
+        sys.stdout.flush()
+        profile.print_summary()
 
 if __name__ == "__main__":
     main()
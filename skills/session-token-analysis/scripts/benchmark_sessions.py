@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+"""
+Session Token Analysis Benchmarks
+
+Generates a deterministic synthetic ~/.claude/projects tree and measures
+analyze_sessions.py against it: discovery, parsing, metric computation and
+full end-to-end runs, reporting MB/s, sessions/s and peak RSS per phase.
+
+Each phase runs in a freshly spawned process. On Linux a child inherits its
+parent's peak RSS across fork and exec, so the corpus is generated (and the
+decoder checked) in spawned processes too: the parent that launches every
+phase never holds more than the interpreter and the analysis module, and a
+phase's peak RSS is its own.
+
+No external dependencies — uses only Python standard library.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows: peak RSS is reported as N/A
+    resource = None
+
+import analyze_sessions as analysis
+
+# Generator parameters that change the corpus (and so its cache key)
+CORPUS_PARAMS = (
+    "sessions", "turns", "payload_kb", "projects", "opus_share", "haiku_share",
+    "compaction_rate", "malformed_rate", "resume_rate", "corpus_mb", "seed",
+)
+
+FILLER = (
+    "def handler(event, context):\n    return {'status': 200, \"body\": json.dumps(event)}\n"
+    "    # TODO: tighten validation before release\t\\n escapes and \"quotes\" included\n"
+)
+
+
+# ---------------------------------------------------------------------------
+# Synthetic corpus generation
+# ---------------------------------------------------------------------------
+
+def iso(ts):
+    return ts.strftime("%Y-%m-%dT%H:%M:%S.") + f"{ts.microsecond // 1000:03d}Z"
+
+
+def payload(rnd, size):
+    """Deterministic tool output of roughly `size` characters."""
+    start = rnd.randrange(len(FILLER))
+    return (FILLER * (size // len(FILLER) + 2))[start:start + size]
+
+
+def pick_model(rnd, opus_share, haiku_share):
+    r = rnd.random()
+    if r < opus_share:
+        return "claude-opus-4-6"
+    if r < opus_share + haiku_share:
+        return "claude-haiku-4-5-20251001"
+    return "claude-sonnet-4-5-20250929"
+
+
+def write_session(path, rnd, session_id, start, params, resumed=()):
+    """Write one realistic session JSONL file; returns (bytes written, tail to resume from).
+
+    `resumed` lines are copied in first, as a resumed session does. The tail
+    starts at the last tool_result, so a session resuming from it carries a
+    result whose tool_use is only in this file.
+    """
+    model = pick_model(rnd, params["opus_share"], params["haiku_share"])
+    payload_size = params["payload_kb"] * 1024
+    common = {
+        "isSidechain": False, "userType": "external", "cwd": "/home/user/project",
+        "sessionId": session_id, "version": "2.1.0", "gitBranch": "main",
+    }
+    ts = start
+    context = rnd.randint(15_000, 25_000)
+    parent = None
+    lines = [json.dumps({"type": "summary", "summary": "Synthetic benchmark session", "leafUuid": session_id}),
+             *resumed]
+
+    def entry(kind, message, **extra):
+        nonlocal parent
+        uuid = f"{session_id}-{len(lines):06d}"
+        obj = {"parentUuid": parent, **common, "type": kind, "message": message,
+               "uuid": uuid, "timestamp": iso(ts), **extra}
+        parent = uuid
+        lines.append(json.dumps(obj))
+
+    entry("user", {"role": "user", "content": "<command-name>/brainstorm</command-name> plan the feature"})
+    for turn in range(params["turns"]):
+        ts += timedelta(seconds=rnd.randint(2, 40) if rnd.random() > 0.03 else rnd.randint(300, 1200))
+        if rnd.random() < params["compaction_rate"]:
+            context = rnd.randint(15_000, 30_000)
+        else:
+            context += rnd.randint(300, 3_000) + payload_size // 4
+        tool_id = f"toolu_{session_id[:8]}{turn:05d}"
+        tool = rnd.choice(("Read", "Bash", "Grep", "Edit", "Task"))
+        cache_creation = rnd.randint(0, 4_000)
+        entry("assistant", {
+            "id": f"msg_{session_id[:8]}{turn:05d}", "type": "message", "role": "assistant", "model": model,
+            "content": [{"type": "text", "text": "Checking the handler."},
+                        {"type": "tool_use", "id": tool_id, "name": tool, "input": {"file_path": "/src/app.py"}}],
+            "stop_reason": "tool_use",
+            "usage": {"input_tokens": rnd.randint(1, 10), "output_tokens": rnd.randint(40, 1_500),
+                      "cache_creation_input_tokens": cache_creation,
+                      "cache_read_input_tokens": max(0, context - cache_creation)},
+        }, requestId=f"req_{session_id[:8]}{turn:05d}")
+
+        ts += timedelta(seconds=rnd.randint(1, 20))
+        output = payload(rnd, rnd.randint(payload_size // 2, payload_size * 3 // 2))
+        entry("user", {"role": "user", "content": [
+            {"tool_use_id": tool_id, "type": "tool_result", "content": output}]},
+            toolUseResult={"stdout": output, "stderr": "", "interrupted": False})
+
+        if rnd.random() < 0.05:
+            lines.append(json.dumps({"type": "file-history-snapshot", "messageId": parent,
+                                     "snapshot": {"trackedFileBackups": {"/src/app.py": output[:2_000]}}}))
+        if rnd.random() < params["malformed_rate"]:
+            lines.append('{"type": "assistant", "message": {"role": "assist')
+
+    data = ("\n".join(lines) + "\n").encode()
+    path.write_bytes(data)
+    mtime = ts.timestamp()
+    os.utime(path, (mtime, mtime))
+    last_result = max((i for i, line in enumerate(lines) if '"tool_result"' in line), default=len(lines))
+    return len(data), lines[last_result:]
+
+
+def corpus_key(params):
+    raw = json.dumps({k: params[k] for k in CORPUS_PARAMS}, sort_keys=True)
+    return hashlib.sha1(raw.encode()).hexdigest()[:12]
+
+
+def generate_corpus(root, params):
+    """Generate (or reuse) a corpus under root; returns its manifest dict.
+
+    With corpus_mb set, sessions are written until the corpus reaches that
+    size; otherwise exactly `sessions` files are written.
+    """
+    root = Path(root)
+    manifest_path = root / "manifest.json"
+    key = corpus_key(params)
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest.get("key") == key:
+            return manifest
+        shutil.rmtree(root)
+
+    projects_dir = root / "projects"
+    projects_dir.mkdir(parents=True)
+    rnd = random.Random(params["seed"])
+    start = datetime(2026, 1, 5, 9, 0, tzinfo=timezone.utc)
+    target = params["corpus_mb"] * 1024 * 1024 if params["corpus_mb"] else None
+    total_bytes = 0
+    count = 0
+    tails = {}  # project -> tail of its latest session, for the next one to resume
+    while (total_bytes < target) if target else (count < params["sessions"]):
+        project = projects_dir / f"-home-user-project-{count % params['projects']:03d}"
+        project.mkdir(exist_ok=True)
+        session_id = f"{rnd.getrandbits(64):016x}-{count:06d}"
+        resumed = tails.get(project, ()) if rnd.random() < params["resume_rate"] else ()
+        size, tails[project] = write_session(project / f"{session_id}.jsonl", rnd, session_id, start, params,
+                                             resumed)
+        total_bytes += size
+        start += timedelta(minutes=rnd.randint(5, 240))
+        count += 1
+
+    manifest = {"key": key, "params": params, "sessions": count, "bytes": total_bytes,
+                "root": str(projects_dir)}
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+# ---------------------------------------------------------------------------
+# Benchmark phases (each runs in a spawned child process)
+# ---------------------------------------------------------------------------
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # Include --jobs workers: the largest single process is the figure that matters
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports KiB, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def phase_discovery(root, jobs):
+    start = time.perf_counter()
+    files = analysis.find_session_files(None, root=root)
+    return time.perf_counter() - start, len(files)
+
+
+def phase_parse(root, jobs):
+    files = analysis.find_session_files(None, root=root)
+    start = time.perf_counter()
+    for path in files:
+        analysis.parse_session(path)
+    return time.perf_counter() - start, len(files)
+
+
+def phase_metrics(root, jobs):
+    files = analysis.find_session_files(None, root=root)
+    elapsed = 0.0
+    for path in files:
+        messages = analysis.parse_session(path)
+        start = time.perf_counter()
+        analysis.compute_session_metrics(path, messages)
+        elapsed += time.perf_counter() - start
+    return elapsed, len(files)
+
+
+def phase_end_to_end(root, jobs, cache_path=None):
+    start = time.perf_counter()
+    files = analysis.find_session_files(None, root=root)
+    count = sum(1 for _, m in analysis.analyse_sessions(files, cache_path, jobs) if m is not None)
+    return time.perf_counter() - start, count
+
+
+def phase_cache_cold(root, jobs, cache_path):
+    if Path(cache_path).exists():
+        Path(cache_path).unlink()
+    return phase_end_to_end(root, jobs, cache_path)
+
+
+def phase_cache_warm(root, jobs, cache_path):
+    return phase_end_to_end(root, jobs, cache_path)
+
+
+def _unsized(message):
+    """A parse_entry result with tool_result sizes dropped, keeping the ids."""
+    if message is None:
+        return None
+    return {**message, "tool_results": [tool_id for tool_id, _ in message["tool_results"] or ()]}
+
+
+def verify_decoder(root, limit=20):
+    """Check decode_entry_fields against json.loads on every large corpus line.
+
+    Both results go through parse_entry and must agree. tool_result sizes are
+    compared on the compact re-encoding of the line, the form _content_chars
+    measures, since the generator writes ASCII-escaped JSON whose raw spans
+    are longer. Returns (lines checked, json.loads fallbacks, mismatches).
+    """
+    checked = fallbacks = 0
+    mismatches = []
+    for path in analysis.find_session_files(None, root=root):
+        with open(path, encoding="utf-8") as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if len(line) < analysis.SELECTIVE_DECODE_MIN_BYTES:
+                    continue
+                checked += 1
+                try:
+                    loaded = json.loads(line)
+                except json.JSONDecodeError:
+                    loaded = None
+                try:
+                    entry = analysis.decode_entry_fields(line)
+                except (ValueError, IndexError):
+                    fallbacks += 1
+                    continue
+                if loaded is None:
+                    problem = "accepted a line json.loads rejects"
+                else:
+                    expected = analysis.parse_entry(loaded)
+                    compact = json.dumps(loaded, ensure_ascii=False, separators=(",", ":"))
+                    if analysis.parse_entry(analysis.decode_entry_fields(compact)) != expected:
+                        problem = "differs from json.loads"
+                    elif _unsized(analysis.parse_entry(entry)) != _unsized(expected):
+                        problem = "differs from json.loads on the raw line"
+                    else:
+                        continue
+                mismatches.append(f"{path}:{lineno}: {problem}")
+                if len(mismatches) >= limit:
+                    return checked, fallbacks, mismatches
+    return checked, fallbacks, mismatches
+
+
+def verify_attribution(root, limit=20):
+    """Check every session's tool attribution costs no more than its main thread.
+
+    Runs with and without de-duplication, so resumed sessions are checked
+    both with their copied entries skipped and with a carried-over
+    tool_result whose tool_use is in another file. Returns (sessions
+    checked, unmatched tool results seen, problems).
+    """
+    files = analysis.find_session_files(None, root=root)[::-1]
+    checked = unmatched = 0
+    problems = []
+    for seen in (set(), None):
+        for file_path, metrics in analysis.analyse_sessions(files, seen=seen):
+            if metrics is None:
+                continue
+            checked += 1
+            unmatched += metrics["unmatched_tool_results"]
+            attributed = sum(t["cost"] for t in metrics["tool_attribution"].values())
+            if attributed > metrics["main_cost"] + 1e-9:
+                problems.append(f"{file_path}: tools ${attributed:.4f} > main thread ${metrics['main_cost']:.4f}"
+                                f"{'' if seen is None else ' (de-duplicated)'}")
+                if len(problems) >= limit:
+                    return checked, unmatched, problems
+    return checked, unmatched, problems
+
+
+PHASES = {
+    "discovery": phase_discovery,
+    "parse": phase_parse,
+    "metrics": phase_metrics,
+    "end-to-end": phase_end_to_end,
+    "cache-cold": phase_cache_cold,
+    "cache-warm": phase_cache_warm,
+}
+
+
+def run_phase(name, root, jobs, cache_path):
+    func = PHASES[name]
+    if name.startswith("cache-"):
+        seconds, sessions = func(root, jobs, cache_path)
+    else:
+        seconds, sessions = func(root, jobs)
+    return {"phase": name, "seconds": seconds, "sessions": sessions, "peak_rss_mb": peak_rss_mb()}
+
+
+def _child(conn, func, args):
+    try:
+        conn.send(func(*args))
+    except BaseException as e:
+        conn.send(e)
+        raise
+    finally:
+        conn.close()
+
+
+def run_isolated(func, *args):
+    """Call func(*args) in a fresh spawned interpreter and return its result.
+
+    Keeps the parent small, so phases spawned from it start from the
+    interpreter's own RSS rather than inheriting the generator's peak. A
+    plain Process rather than a Pool: pool workers are daemonic and can't
+    start the --jobs process pool the end-to-end phases need.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    recv_conn, send_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(send_conn, func, args))
+    proc.start()
+    send_conn.close()
+    try:
+        result = recv_conn.recv()
+    except EOFError:
+        result = RuntimeError(f"{func.__name__} exited with code {proc.exitcode}")
+    proc.join()
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+def print_results(manifest, results, jobs):
+    total_mb = manifest["bytes"] / (1024 * 1024)
+    print(f"\n{'=' * 78}")
+    print("  SESSION ANALYSIS BENCHMARK")
+    print(f"{'=' * 78}\n")
+    print(f"  Corpus:   {manifest['root']}")
+    print(f"  Sessions: {manifest['sessions']:,}  ({total_mb:,.1f} MB)")
+    print(f"  Jobs:     {jobs}")
+    print(f"  Python:   {sys.version.split()[0]} on {sys.platform}\n")
+
+    col_w = 12
+    header = (f"  {'Phase':<14} {'Seconds':>{col_w}} {'MB/s':>{col_w}} "
+              f"{'Sessions/s':>{col_w}} {'Peak RSS':>{col_w}}")
+    print(header)
+    print(f"  {'-' * (len(header) - 2)}")
+    for r in results:
+        seconds = r["seconds"]
+        # Discovery and metrics don't read session bytes, so MB/s would mislead
+        reads_bytes = r["phase"] not in ("discovery", "metrics")
+        mb_s = f"{total_mb / seconds:,.1f}" if seconds > 0 and reads_bytes else "-"
+        sess_s = f"{r['sessions'] / seconds:,.1f}" if seconds > 0 else "-"
+        rss = f"{r['peak_rss_mb']:,.1f} MB" if r["peak_rss_mb"] is not None else "N/A"
+        print(f"  {r['phase']:<14} {seconds:>{col_w}.3f} {mb_s:>{col_w}} {sess_s:>{col_w}} {rss:>{col_w}}")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark analyze_sessions.py against a deterministic synthetic session corpus."
+    )
+    parser.add_argument("--dir", type=str, default=None,
+                        help="Corpus directory, reused across runs when parameters match "
+                             "(default: <tmp>/session-bench-<params>)")
+    parser.add_argument("--sessions", type=int, default=50, help="Number of sessions (default: 50)")
+    parser.add_argument("--corpus-mb", type=int, default=0,
+                        help="Generate sessions until the corpus reaches this size, overriding --sessions "
+                             "(e.g. 1100 for a 1 GB+ run)")
+    parser.add_argument("--turns", type=int, default=150, help="Assistant turns per session (default: 150)")
+    parser.add_argument("--payload-kb", type=int, default=8,
+                        help="Average tool_result payload size in KiB (default: 8)")
+    parser.add_argument("--projects", type=int, default=12, help="Project directories (default: 12)")
+    parser.add_argument("--opus-share", type=float, default=0.5, help="Fraction of Opus sessions (default: 0.5)")
+    parser.add_argument("--haiku-share", type=float, default=0.1, help="Fraction of Haiku sessions (default: 0.1)")
+    parser.add_argument("--compaction-rate", type=float, default=0.01,
+                        help="Per-turn probability of a compaction drop (default: 0.01)")
+    parser.add_argument("--malformed-rate", type=float, default=0.01,
+                        help="Per-turn probability of a truncated JSON line (default: 0.01)")
+    parser.add_argument("--resume-rate", type=float, default=0.1,
+                        help="Probability that a session resumes its project's previous one, copying "
+                             "its entries from the last tool_result on (default: 0.1)")
+    parser.add_argument("--seed", type=int, default=1234, help="Generator seed (default: 1234)")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="--jobs for end-to-end phases (default: 1)")
+    parser.add_argument("--phases", type=str, default=",".join(PHASES),
+                        help=f"Comma-separated phases to run (default: {','.join(PHASES)})")
+    parser.add_argument("--json", type=str, default=None,
+                        help="Also write results as JSON to this path for run-to-run comparison")
+    parser.add_argument("--generate-only", action="store_true", help="Generate the corpus and exit")
+    parser.add_argument("--verify", action="store_true",
+                        help="Before running phases, check the selective line decoder against json.loads "
+                             "and that tool attribution never exceeds session cost; exits 1 on any failure")
+    args = parser.parse_args()
+
+    phases = [p.strip() for p in args.phases.split(",") if p.strip()]
+    unknown = [p for p in phases if p not in PHASES]
+    if unknown:
+        parser.error(f"unknown phase(s): {', '.join(unknown)}")
+
+    params = {k: getattr(args, k) for k in CORPUS_PARAMS}
+    corpus_dir = Path(args.dir) if args.dir else Path(tempfile.gettempdir()) / f"session-bench-{corpus_key(params)}"
+
+    start = time.perf_counter()
+    manifest = run_isolated(generate_corpus, corpus_dir, params)
+    print(f"  Corpus ready in {time.perf_counter() - start:.1f}s: "
+          f"{manifest['sessions']:,} sessions, {manifest['bytes'] / (1024 * 1024):,.1f} MB")
+    if args.generate_only:
+        return
+
+    if args.verify:
+        checked, fallbacks, mismatches = run_isolated(verify_decoder, manifest["root"])
+        print(f"  Decoder check: {checked:,} large lines, {fallbacks:,} fell back to json.loads, "
+              f"{len(mismatches)} mismatches")
+        sessions, unmatched, problems = run_isolated(verify_attribution, manifest["root"])
+        print(f"  Attribution check: {sessions:,} session analyses, {unmatched:,} unmatched tool results, "
+              f"{len(problems)} over cost")
+        for failure in mismatches + problems:
+            print(f"    {failure}")
+        if mismatches or problems:
+            sys.exit(1)
+
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    cache_path = str(corpus_dir / "parse-cache.sqlite3")
+    results = []
+    for name in phases:
+        print(f"  Running {name}...", flush=True)
+        results.append(run_isolated(run_phase, name, manifest["root"], jobs, cache_path))
+
+    print_results(manifest, results, jobs)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps({
+            "generated": datetime.now().isoformat(), "corpus": manifest, "jobs": jobs, "results": results,
+        }, indent=2))
+
+
+if __name__ == "__main__":
+    main()